@@ -21,134 +21,2031 @@ Syphon: download, rip, normalize gains and trim start/end silences from
 """
 
 from configparser import ConfigParser
-from subprocess import Popen, PIPE
-from multiprocessing.dummy import Pool as ThreadPool
+from collections import deque, namedtuple
+from contextlib import AsyncExitStack, closing, contextmanager
+from functools import partial
+from importlib import import_module
+from urllib.parse import urlparse, urlencode
+import argparse
+import threading
+import time
+import re
+import hashlib
+import json
+import base64
+import io
+import resource
+import tempfile
+from subprocess import Popen, PIPE, DEVNULL
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import as_completed, Future, CancelledError
+from concurrent.futures import BrokenExecutor
+from socketserver import ThreadingUnixStreamServer, StreamRequestHandler
+import queue
 import os
-from shutil import copyfile
+import fcntl
 from shutil import copy2
+from shutil import copystat
 from shutil import rmtree
 import logging
-from sqlite3 import dbapi2 as sqlite
 import pickle
-from mutagen.oggvorbis import OggVorbis
-import acoustid
+
+
+class LazyModule():
+    '''LazyModule'''
+    def __init__(self, name):
+        self.__name = name
+        self.__module = None
+
+    def __getattr__(self, attribute):
+        '''__getattr__'''
+        if self.__module is None:
+            self.__module = import_module(self.__name)
+        return getattr(self.__module, attribute)
+
+
+# Heavy modules are only imported by the first stage that uses them, so
+# that quick commands do not pay for numpy, acoustid or asyncio
+ast = LazyModule("ast")
+asyncio = LazyModule("asyncio")
+multiprocessing = LazyModule("multiprocessing")
+urlrequest = LazyModule("urllib.request")
+sqlite = LazyModule("sqlite3")
+np = LazyModule("numpy")
+mutagen = LazyModule("mutagen")
+oggvorbis = LazyModule("mutagen.oggvorbis")
+acoustid = LazyModule("acoustid")
 
 CFG_PATH = "/usr/share/syphon"
 
+ACOUSTID_URL = "https://api.acoustid.org/v2/lookup"
+
+# Same meaning as the sox "silence 1 120 2%" parameters: the audio is kept
+# from the first run of SILENCE_DURATION (seconds, or samples with an "s"
+# suffix) above SILENCE_THRESHOLD (percentage or dB of full scale)
+SILENCE_DURATION = "120"
+SILENCE_THRESHOLD = "2%"
+# Length in seconds of the RMS window used to measure the level
+SILENCE_WINDOW = 0.02
+
+# Opus is always decoded at 48 kHz. Sources in other codecs are re-encoded
+# to Vorbis at their own bitrate, but at least CONDITIONER_MIN_BITRATE kbps
+# since Vorbis needs more bits than Opus or AAC for the same quality
+OPUS_RATE = 48000
+CONDITIONER_MIN_BITRATE = 128
+
+# Tracks are never decoded whole but read CONDITIONER_CHUNK frames at a
+# time, so a DJ set needs no more memory than a single: their level is
+# measured on CONDITIONER_SEGMENT seconds long segments in parallel, and the
+# trailing silence is searched in the last CONDITIONER_TAIL seconds, doubled
+# until a long enough run of sound is found
+CONDITIONER_CHUNK = 1 << 18
+CONDITIONER_SEGMENT = 600
+CONDITIONER_TAIL = 300
+
+# Bumped whenever a change to Conditioner alters its output, so that
+# cached conditioned files are not reused across versions
+CONDITIONER_VERSION = 2
+
+# ioctl request cloning a whole file (reflink) on btrfs, xfs and other
+# copy-on-write filesystems
+FICLONE = 0x40049409
+
+# Seconds between two checks of the custom playlists folder in daemon mode,
+# and commands accepted on the control socket
+DAEMON_POLL = 2
+DAEMON_COMMANDS = ("sync", "custom", "devices", "reload", "stop")
+
+# Files of the internal trees are spread over 16 ** SHARD_WIDTH
+# subdirectories named after the start of the hash of their name
+SHARD_WIDTH = 2
+
+# Fingerprint index: items are indexed by their top bits, one every
+# stride positions, and candidates need a minimum number of hits at the
+# same alignment before being compared bit by bit
+INDEX_SHIFT = 12
+INDEX_CANDIDATES = 5
+INDEX_MIN_VOTES = 5
+
+# Seconds the resolver waits for more fingerprints to fill a batch, and
+# timeout of a single lookup request
+RESOLVER_WAIT = 0.5
+RESOLVER_TIMEOUT = 30
+
+# Per-track stages with their own worker pool, and the ones whose work is
+# picklable and may therefore be moved to a process pool
+STAGES = ("condition", "fingerprint", "convert")
+PROCESS_STAGES = ("condition", "fingerprint")
+
+# Stages of a run that can be selected from the command line, and the ones
+# among them that work on each track
+PIPELINE_STAGES = ("download", "condition", "index", "tag", "convert",
+                   "playlists", "devices")
+TRACK_STAGES = ("condition", "index", "tag", "convert")
+
+# ffmpeg output options for each format a device can ask for, {quality}
+# is replaced by the configured QUALITY. The library is always mp3
+ENCODER_FORMATS = {
+    "mp3": ["-c:a", "libmp3lame", "-q:a", "{quality}",
+            "-id3v2_version", "3", "-f", "mp3"],
+    "ogg": ["-c:a", "libvorbis", "-q:a", "{quality}", "-f", "ogg"],
+    "opus": ["-c:a", "libopus", "-b:a", "{quality}k", "-f", "opus"],
+    }
+# Default QUALITY of each format, on its own scale: VBR level for mp3 and
+# ogg, kbps for opus
+ENCODER_QUALITY = {"mp3": "6", "ogg": "6", "opus": "128"}
+
+# Marker printed by youtube-dl --exec once a file is completely processed
+DOWNLOADED = "SYPHON-DOWNLOADED"
+YOUTUBE_URL = "https://www.youtube.com/watch?v="
+
+# Downloaded audio, kept in the codec served by the site, and videos left
+# behind by earlier versions that kept them next to the extracted audio
+AUDIO_EXTENSIONS = (".ogg", ".opus", ".m4a", ".aac", ".mp3", ".flac", ".wav")
+VIDEO_EXTENSIONS = (".webm", ".mp4", ".mkv", ".flv", ".3gp")
+
+# Longest line kept from a command output, longer ones are split
+MAX_LINE = 4096
+
+# Seconds between two samples of the CPU time and I/O of a running command,
+# which can no longer be read once the process has been reaped
+USAGE_INTERVAL = 0.25
+
+ITEM_RE = re.compile(r"^\[download\] Downloading (?:video|item) "
+                     r"(\d+) of (\d+)")
+PERCENT_RE = re.compile(r"^\[download\]\s+([\d.]+)%")
+TIME_RE = re.compile(r"\btime=(\d+):(\d+):([\d.]+)")
+
+CommandResult = namedtuple("CommandResult",
+                           ["command", "returncode", "output", "err",
+                            "elapsed", "waited", "progress", "usage"])
+
+# Quantities summed for each stage: runs, wall and CPU seconds, bytes read
+# and written, and seconds spent queued before starting
+METRICS_FIELDS = ("count", "wall", "cpu", "read", "written", "wait")
+PROMETHEUS_NAMES = {
+    "count": ("syphon_stage_runs", "Number of runs of the stage"),
+    "wall": ("syphon_stage_wall_seconds", "Wall time spent in the stage"),
+    "cpu": ("syphon_stage_cpu_seconds", "CPU time spent in the stage"),
+    "read": ("syphon_stage_read_bytes", "Bytes read by the stage"),
+    "written": ("syphon_stage_written_bytes", "Bytes written by the stage"),
+    "wait": ("syphon_stage_wait_seconds", "Time queued before the stage"),
+    }
+
+
+class Metrics():
+    '''Metrics'''
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__stages = {}
+        self.__started = time.time()
 
-class Syphon():
-    '''Syphon'''
     @classmethod
-    def __preparepaths(cls, cfgpath, basepath):
-        '''__preparepaths'''
-        cls.__paths = {}
-        cls.__paths["cfg"] = cfgpath
-        cls.__paths["basepath"] = basepath
-        cls.__paths["downloads"] = os.path.join(basepath, "downloads")
-        cls.__paths["normalized"] = os.path.join(basepath, "normalized")
-        cls.__paths["pool"] = os.path.join(basepath, "pool")
-        cls.__paths["mp3"] = os.path.join(basepath, "mp3")
-        cls.__paths["pls"] = os.path.join(basepath, "playlists")
-        cls.__paths["custom"] = os.path.join(basepath, "custom")
-        cls.__paths["devices"] = os.path.join(basepath, "devices")
-
-    @classmethod
-    def __inpath(cls, path, filename):
-        '''__inpath'''
-        return os.path.join(cls.__paths[path], filename)
+    def __readproc(cls, path):
+        '''__readproc'''
+        try:
+            with open(path) as infile:
+                return infile.read()
+        except OSError:
+            return ""
+
+    @classmethod
+    def __io(cls, path):
+        '''__io'''
+        fields = dict(line.split(":", 1)
+                      for line in cls.__readproc(path).splitlines())
+        return int(fields.get("rchar", 0)), int(fields.get("wchar", 0))
+
+    @classmethod
+    def sample(cls):
+        '''sample'''
+        read, written = cls.__io("/proc/thread-self/io")
+        return {"wall": time.monotonic(), "cpu": time.thread_time(),
+                "read": read, "written": written}
+
+    @classmethod
+    def sampleprocess(cls, pid):
+        '''sampleprocess'''
+        stat = cls.__readproc("/proc/" + str(pid) + "/stat")
+        if not stat:
+            return None
+        # utime, stime, cutime and cstime follow the command name
+        ticks = stat.rsplit(")", 1)[-1].split()[11:15]
+        read, written = cls.__io("/proc/" + str(pid) + "/io")
+        return {"cpu": sum(int(x) for x in ticks) /
+                os.sysconf("SC_CLK_TCK"),
+                "read": read, "written": written}
+
+    @classmethod
+    def delta(cls, before, after, wait=0.0):
+        '''delta'''
+        sample = {key: after[key] - before[key] for key in before}
+        sample["wait"] = wait
+        return sample
+
+    @classmethod
+    def timed(cls, submitted, action, *args):
+        '''timed'''
+        before = cls.sample()
+        wait = time.time() - submitted
+        result = action(*args)
+        return result, cls.delta(before, cls.sample(), wait)
+
+    @contextmanager
+    def measure(self, stage, label="", submitted=None):
+        '''measure'''
+        before = self.sample()
+        wait = 0.0 if submitted is None else time.time() - submitted
+        try:
+            yield
+        finally:
+            self.record(stage, label, self.delta(before, self.sample(), wait))
+
+    def record(self, stage, label, sample):
+        '''record'''
+        with self.__lock:
+            entry = self.__stages.setdefault(
+                (stage, label), dict.fromkeys(METRICS_FIELDS, 0))
+            entry["count"] += 1
+            for key in sample:
+                entry[key] += sample[key]
+
+    def report(self):
+        '''report'''
+        finished = time.time()
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        stages = {}
+        with self.__lock:
+            for (stage, label), entry in sorted(self.__stages.items()):
+                total = stages.setdefault(stage, dict(
+                    dict.fromkeys(METRICS_FIELDS, 0), labels={}))
+                for key in METRICS_FIELDS:
+                    total[key] += entry[key]
+                if label:
+                    total["labels"][label] = dict(entry)
+        return {"started": self.__started, "finished": finished,
+                "wall": finished - self.__started,
+                "cpu": time.process_time(),
+                "childrencpu": children.ru_utime + children.ru_stime,
+                "stages": stages}
+
+    @classmethod
+    def __escape(cls, value):
+        '''__escape'''
+        return value.replace("\\", "\\\\").replace('"', '\\"') \
+                    .replace("\n", "\\n")
+
+    def prometheus(self, report):
+        '''prometheus'''
+        lines = []
+        with self.__lock:
+            entries = sorted(self.__stages.items())
+        for key in METRICS_FIELDS:
+            name, description = PROMETHEUS_NAMES[key]
+            lines += ["# HELP " + name + " " + description + " last run",
+                      "# TYPE " + name + " gauge"]
+            for (stage, label), entry in entries:
+                lines.append(name + '{stage="' + self.__escape(stage) +
+                             '",label="' + self.__escape(label) + '"} ' +
+                             repr(entry[key]))
+        lines += ["# HELP syphon_run_wall_seconds Duration of the last run",
+                  "# TYPE syphon_run_wall_seconds gauge",
+                  "syphon_run_wall_seconds " + repr(report["wall"]),
+                  "# HELP syphon_run_finished_seconds End of the last run",
+                  "# TYPE syphon_run_finished_seconds gauge",
+                  "syphon_run_finished_seconds " + repr(report["finished"])]
+        return "\n".join(lines) + "\n"
+
+    def write(self, reportpath, prometheuspath):
+        '''write'''
+        report = self.report()
+        outputs = [(reportpath, json.dumps(report, indent=2, sort_keys=True)),
+                   (prometheuspath, self.prometheus(report))]
+        for path, content in outputs:
+            if not path:
+                continue
+            with open(path + ".part", "w") as outfile:
+                outfile.write(content)
+            os.replace(path + ".part", path)
+        return report
+
+
+class Scheduler():
+    '''Scheduler'''
+    def __init__(self, maxcommands, maxdownloads, maxperhost, maxlines,
+                 metrics=None):
+        self.__maxcommands = maxcommands
+        self.__maxdownloads = maxdownloads
+        self.__maxperhost = maxperhost
+        self.__maxlines = maxlines
+        self.__metrics = metrics
+        self.__loop = None
+        self.__thread = None
+
+    async def __prepare(self):
+        '''__prepare'''
+        self.__commands = asyncio.Semaphore(self.__maxcommands)
+        self.__downloads = asyncio.Semaphore(self.__maxdownloads)
+        self.__hosts = {}
+
+    def start(self):
+        '''start'''
+        self.__loop = asyncio.new_event_loop()
+        self.__thread = threading.Thread(target=self.__loop.run_forever,
+                                         name="scheduler", daemon=True)
+        self.__thread.start()
+        asyncio.run_coroutine_threadsafe(self.__prepare(),
+                                         self.__loop).result()
+
+    def stop(self):
+        '''stop'''
+        self.__loop.call_soon_threadsafe(self.__loop.stop)
+        self.__thread.join()
+        self.__loop.close()
+
+    def __limits(self, host):
+        '''__limits'''
+        if host is None:
+            return [self.__commands]
+        if host not in self.__hosts:
+            self.__hosts[host] = asyncio.Semaphore(self.__maxperhost)
+        return [self.__downloads, self.__hosts[host]]
+
+    def __parseprogress(self, progress, line):
+        '''__parseprogress'''
+        match = ITEM_RE.match(line)
+        if match:
+            progress["item"] = int(match.group(1))
+            progress["items"] = int(match.group(2))
+            progress["percent"] = 0.0
+            logging.debug("Downloading item " + match.group(1) +
+                          " of " + match.group(2))
+            return
+        match = PERCENT_RE.match(line)
+        if match:
+            progress["percent"] = float(match.group(1))
+            return
+        match = TIME_RE.search(line)
+        if match:
+            progress["time"] = (int(match.group(1)) * 3600 +
+                                int(match.group(2)) * 60 +
+                                float(match.group(3)))
+
+    async def __readlines(self, stream, lines, progress, online):
+        '''__readlines'''
+        pending = b""
+        while True:
+            chunk = await stream.read(65536)
+            if chunk:
+                pending += chunk.replace(b"\r", b"\n")
+                *complete, pending = pending.split(b"\n")
+                while len(pending) > MAX_LINE:
+                    complete.append(pending[:MAX_LINE])
+                    pending = pending[MAX_LINE:]
+            elif pending:
+                complete = [pending]
+                pending = b""
+            else:
+                break
+            for line in complete:
+                line = line[:MAX_LINE].decode("utf-8", "replace")
+                lines.append(line)
+                self.__parseprogress(progress, line)
+                if online is not None:
+                    online(line)
+
+    async def __sampleusage(self, pid, usage):
+        '''__sampleusage'''
+        while True:
+            sample = Metrics.sampleprocess(pid)
+            if sample is not None:
+                usage.update(sample)
+            await asyncio.sleep(USAGE_INTERVAL)
+
+    async def __run(self, command, host, cwd, online, metrics):
+        '''__run'''
+        queued = time.monotonic()
+        async with AsyncExitStack() as stack:
+            for limit in self.__limits(host):
+                await stack.enter_async_context(limit)
+            started = time.monotonic()
+            proc = await asyncio.create_subprocess_exec(
+                *command, cwd=cwd, stdin=asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE)
+            output = deque(maxlen=self.__maxlines)
+            err = deque(maxlen=self.__maxlines)
+            progress = {}
+            usage = {"cpu": 0.0, "read": 0, "written": 0}
+            sampler = asyncio.ensure_future(
+                self.__sampleusage(proc.pid, usage))
+            try:
+                await asyncio.gather(
+                    self.__readlines(proc.stdout, output, progress, online),
+                    self.__readlines(proc.stderr, err, progress, None))
+            finally:
+                sampler.cancel()
+            sample = Metrics.sampleprocess(proc.pid)
+            if sample is not None:
+                usage.update(sample)
+            returncode = await proc.wait()
+        result = CommandResult(command=command, returncode=returncode,
+                               output="\n".join(output), err="\n".join(err),
+                               elapsed=time.monotonic() - started,
+                               waited=started - queued, progress=progress,
+                               usage=usage)
+        if metrics is None:
+            metrics = self.__metrics
+        if metrics is not None:
+            metrics.record("command", os.path.basename(command[0]),
+                           dict(usage, wall=result.elapsed,
+                                wait=result.waited))
+        logging.info("Command: " + " ".join(command) +
+                     "\nReturn Code: " + str(returncode) +
+                     " in " + "%.2f" % result.elapsed + "s" +
+                     " (queued " + "%.2f" % result.waited + "s)")
+        if returncode:
+            logging.warning("Command failed: " + " ".join(command) +
+                            "\nOutput:\n" + result.output +
+                            "\nError:\n" + result.err + "\n")
+        return result
+
+    def submit(self, command, host=None, cwd=None, online=None,
+               metrics=None):
+        '''submit'''
+        return asyncio.run_coroutine_threadsafe(
+            self.__run(command, host, cwd, online, metrics), self.__loop)
+
+    def run(self, command, host=None, cwd=None, online=None, metrics=None):
+        '''run'''
+        return self.submit(command, host, cwd, online, metrics).result()
+
+
+class StageError(Exception):
+    '''StageError'''
+    def __init__(self, message, permanent=False):
+        super().__init__(message, permanent)
+        self.message = message
+        self.permanent = permanent
+
+    def __str__(self):
+        return self.message
+
+
+class Conditioner():
+    '''Conditioner'''
+    @classmethod
+    def __probe(cls, src):
+        '''__probe'''
+        audio = mutagen.File(src)
+        if audio is None:
+            raise StageError("Unsupported audio format", permanent=True)
+        return audio
+
+    @classmethod
+    def __getbitrate(cls, audio):
+        '''__getbitrate'''
+        bitrate = int(round(audio.info.bitrate / 1000.0))
+        logging.info("Average bitrate is: " + str(bitrate) + "\n")
+        if bitrate and not isinstance(audio, oggvorbis.OggVorbis):
+            bitrate = max(bitrate, CONDITIONER_MIN_BITRATE)
+        return bitrate
+
+    @classmethod
+    def __stream(cls, src, channels, rate, offset=0, length=None):
+        '''__stream'''
+        command = ["ffmpeg", "-v", "error"]
+        if offset:
+            command += ["-ss", "%.6f" % (offset / rate)]
+        if length is not None:
+            command += ["-t", "%.6f" % (length / rate)]
+        command += ["-i", src, "-ac", str(channels), "-ar", str(rate),
+                    "-f", "f32le", "-"]
+        logging.info("Command:\n" + " ".join(command) + "\n")
+        with tempfile.TemporaryFile() as err:
+            proc = Popen(command, stdin=DEVNULL, stdout=PIPE, stderr=err)
+            finished = False
+            try:
+                while True:
+                    data = proc.stdout.read(CONDITIONER_CHUNK * channels * 4)
+                    if not data:
+                        break
+                    yield np.frombuffer(data, dtype="<f4").reshape(-1,
+                                                                   channels)
+                finished = True
+            finally:
+                if not finished:
+                    proc.kill()
+                proc.stdout.close()
+                retcode = proc.wait()
+            if retcode:
+                err.seek(0)
+                raise StageError("Decoding failed: " +
+                                 err.read().decode("utf-8", "replace"),
+                                 permanent=retcode > 0)
+
+    @classmethod
+    def __encodecommand(cls, channels, rate, src, dst, bitrate):
+        '''__encodecommand'''
+        return ["ffmpeg", "-v", "error", "-y",
+                "-f", "f32le", "-ar", str(rate),
+                "-ac", str(channels), "-i", "-",
+                "-i", src, "-map", "0:a", "-map_metadata", "1",
+                "-c:a", "libvorbis", "-b:a", str(bitrate) + "k",
+                "-f", "ogg", dst]
+
+    @classmethod
+    def __parsethreshold(cls, threshold):
+        '''__parsethreshold'''
+        if threshold.endswith("%"):
+            return float(threshold[:-1]) / 100
+        if threshold.endswith("d"):
+            return 10 ** (float(threshold[:-1]) / 20)
+        return float(threshold)
+
+    @classmethod
+    def __parseduration(cls, duration, rate):
+        '''__parseduration'''
+        if duration.endswith("s"):
+            return int(duration[:-1])
+        return int(round(float(duration) * rate))
+
+    @classmethod
+    def __findrun(cls, above, length):
+        '''__findrun'''
+        if len(above) >= length:
+            counts = np.concatenate(([0], np.cumsum(above, dtype=np.int64)))
+            runs = np.flatnonzero(counts[length:] - counts[:-length] ==
+                                  length)
+            if len(runs) > 0:
+                return int(runs[0])
+        return None
+
+    @classmethod
+    def __windowrms(cls, samples, window):
+        '''__windowrms'''
+        frames = len(samples) // window
+        blocks = samples[:frames * window].reshape(frames, window,
+                                                   samples.shape[1])
+        return np.sqrt(np.mean(np.square(blocks, dtype=np.float64),
+                               axis=1)).max(axis=1)
+
+    @classmethod
+    def __level(cls, energy, count, peak):
+        '''__level'''
+        if count == 0 or energy <= 0:
+            return None, peak
+        level = 10 * np.log10(energy / count)
+        logging.debug("Level: " + str(level) + "dBFS, peak: " + str(peak))
+        return int(round(level)), peak
+
+    @classmethod
+    def __gainfactor(cls, level, peak, gain):
+        '''__gainfactor'''
+        if level is None:
+            logging.info("Only digital silence found, skipping gain")
+            return None
+        delta_gain = gain - level
+        if delta_gain == 0:
+            logging.info("Already at the correct level")
+            return None
+        logging.info("Required adjustment: " + str(delta_gain) + "\n")
+        factor = 10 ** (delta_gain / 20.0)
+        if peak * factor > 1:
+            # Stop at full scale rather than clipping the peaks
+            logging.warning("Gain adjustment would clip the signal, " +
+                            "limiting the adjustment to " +
+                            "%.1f" % (-20 * np.log10(peak)) + "dB")
+            factor = 1.0 / peak
+        return factor
+
+    @classmethod
+    def __adjustgain(cls, samples, factor):
+        '''__adjustgain'''
+        if factor is None:
+            return samples
+        return np.clip(samples * np.float32(factor), -1, 1)
+
+    @classmethod
+    def __measuresegment(cls, src, channels, rate, offset, length):
+        '''__measuresegment'''
+        energy, count, peak = 0.0, 0, 0.0
+        for chunk in cls.__stream(src, channels, rate, offset, length):
+            energy += float(np.sum(np.square(chunk, dtype=np.float64)))
+            count += chunk.size
+            peak = max(peak, float(np.max(np.abs(chunk))))
+        return energy, count, peak
+
+    @classmethod
+    def __analyzestream(cls, src, channels, rate, duration):
+        '''__analyzestream'''
+        logging.info("Extracting gain info.\n")
+        segment = CONDITIONER_SEGMENT * rate
+        offsets = list(range(0, max(1, int(duration * rate)), segment))
+        lengths = [segment] * (len(offsets) - 1) + [None]
+        with ThreadPoolExecutor(min(len(offsets), os.cpu_count() or 1),
+                                thread_name_prefix="segment") as pool:
+            results = list(pool.map(partial(cls.__measuresegment, src,
+                                            channels, rate),
+                                    offsets, lengths))
+        return cls.__level(sum(x[0] for x in results),
+                           sum(x[1] for x in results),
+                           max(x[2] for x in results))
+
+    @classmethod
+    def __streamrms(cls, chunks, window, factor):
+        '''__streamrms'''
+        carry = None
+        for chunk in chunks:
+            chunk = cls.__adjustgain(chunk, factor)
+            if carry is not None:
+                chunk = np.concatenate((carry, chunk))
+            yield cls.__windowrms(chunk, window)
+            carry = chunk[len(chunk) // window * window:]
+
+    @classmethod
+    def __findstart(cls, src, channels, rate, factor, window, length,
+                    threshold):
+        '''__findstart'''
+        position = 0
+        run = 0
+        first = None
+        with closing(cls.__stream(src, channels, rate)) as chunks:
+            for rms in cls.__streamrms(chunks, window, factor):
+                # Loud windows at the end of the previous chunk may start
+                # the run
+                above = np.concatenate((np.ones(run, dtype=bool),
+                                        rms > threshold))
+                found = cls.__findrun(above, length)
+                if found is not None:
+                    return (position - run + found) * window
+                if first is None and above.any():
+                    first = position - run + int(np.argmax(above))
+                quiet = np.flatnonzero(~above)
+                run = len(above) - (int(quiet[-1]) + 1 if len(quiet) else 0)
+                position += len(rms)
+        return None if first is None else first * window
+
+    @classmethod
+    def __findend(cls, src, channels, rate, factor, window, length,
+                  threshold, start, duration):
+        '''__findend'''
+        tail = CONDITIONER_TAIL
+        while True:
+            offset = max(start, int((duration - tail) * rate) //
+                         window * window)
+            chunks = cls.__stream(src, channels, rate, offset)
+            above = np.concatenate([np.zeros(0, dtype=bool)] +
+                                   [x > threshold for x in
+                                    cls.__streamrms(chunks, window, factor)])
+            found = cls.__findrun(above[::-1], length)
+            if found is None and offset > start:
+                logging.info("No sound in the last " + str(tail) +
+                             "s, looking further back")
+                tail *= 2
+                continue
+            if found is None:
+                loud = np.flatnonzero(above[::-1])
+                if len(loud) == 0:
+                    return None
+                found = int(loud[0])
+            if found == 0:
+                return None
+            return offset + (len(above) - found) * window
+
+    @classmethod
+    def __encodestream(cls, src, dst, channels, rate, bitrate, factor,
+                       start, end):
+        '''__encodestream'''
+        logging.info("Encoding.\n")
+        command = cls.__encodecommand(channels, rate, src, dst, bitrate)
+        logging.info("Command:\n" + " ".join(command) + "\n")
+        length = None if end is None else end - start
+        with tempfile.TemporaryFile() as err:
+            proc = Popen(command, stdin=PIPE, stdout=DEVNULL, stderr=err)
+            try:
+                with closing(cls.__stream(src, channels, rate, start,
+                                          length)) as chunks:
+                    for chunk in chunks:
+                        chunk = cls.__adjustgain(chunk, factor)
+                        proc.stdin.write(np.ascontiguousarray(
+                            chunk, dtype="<f4").tobytes())
+            except BrokenPipeError:
+                logging.warning("Encoder exited early")
+            finally:
+                try:
+                    proc.stdin.close()
+                except BrokenPipeError:
+                    pass
+                retcode = proc.wait()
+            logging.info("Return Code:\n" + str(retcode) + "\n")
+            if retcode:
+                err.seek(0)
+                raise StageError("Encoding failed: " +
+                                 err.read().decode("utf-8", "replace"))
+
+    @classmethod
+    def __conditionstream(cls, src, dst, gain, info, bitrate):
+        '''__conditionstream'''
+        logging.info("Conditioning " + str(int(info.length)) +
+                     "s in chunks\n")
+        rate = getattr(info, "sample_rate", OPUS_RATE)
+        level, peak = cls.__analyzestream(src, info.channels, rate,
+                                          info.length)
+        factor = cls.__gainfactor(level, peak, gain)
+        logging.info("Trimming silences.\n")
+        window = max(1, int(rate * SILENCE_WINDOW))
+        length = -(-cls.__parseduration(SILENCE_DURATION, rate) // window)
+        bounds = (src, info.channels, rate, factor, window, max(1, length),
+                  cls.__parsethreshold(SILENCE_THRESHOLD))
+        start = cls.__findstart(*bounds)
+        end = None
+        if start is None:
+            logging.warning("Only silence found, keeping the whole track")
+            start = 0
+        else:
+            end = cls.__findend(*bounds, start, info.length)
+        logging.info("Keeping samples " + str(start) + " to " + str(end))
+        cls.__encodestream(src, dst, info.channels, rate, bitrate, factor,
+                           start, end)
 
     @classmethod
-    def __loadbaseconfig(cls):
+    def condition(cls, src, dst, gain):
+        '''condition'''
+        logging.info("Conditioning " + src)
+        audio = cls.__probe(src)
+        bitrate = cls.__getbitrate(audio)
+        if bitrate == 0:
+            raise StageError("No bitrate found", permanent=True)
+        cls.__conditionstream(src, dst + ".part", gain, audio.info, bitrate)
+        os.replace(dst + ".part", dst)
+        return 0
+
+
+class Materializer():
+    '''Materializer'''
+    @classmethod
+    def __reflink(cls, src, dst):
+        '''__reflink'''
+        with open(src, "rb") as infile, open(dst, "wb") as outfile:
+            fcntl.ioctl(outfile.fileno(), FICLONE, infile.fileno())
+
+    @classmethod
+    def __copyrange(cls, src, dst):
+        '''__copyrange'''
+        with open(src, "rb") as infile, open(dst, "wb") as outfile:
+            remaining = os.fstat(infile.fileno()).st_size
+            while remaining > 0:
+                copied = os.copy_file_range(infile.fileno(),
+                                            outfile.fileno(), remaining)
+                if copied == 0:
+                    break
+                remaining -= copied
+
+    @classmethod
+    def copy(cls, src, dst):
+        '''copy'''
+        for method in (cls.__reflink, cls.__copyrange):
+            try:
+                method(src, dst)
+                copystat(src, dst)
+                return
+            except (OSError, AttributeError):
+                pass
+        copy2(src, dst)
+
+    @classmethod
+    def materialize(cls, src, dst, link=True):
+        '''materialize'''
+        tmp = dst + ".part"
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        if link:
+            try:
+                os.link(src, tmp)
+                os.replace(tmp, dst)
+                return
+            except OSError:
+                pass
+        cls.copy(src, tmp)
+        os.replace(tmp, dst)
+
+
+class Encoder():
+    '''Encoder'''
+    def __init__(self, workers, batch, batchtime, run):
+        self.__workers = workers
+        self.__batch = batch
+        self.__batchtime = batchtime
+        self.__run = run
+        self.__queue = queue.Queue()
+        self.__threads = []
+
+    @classmethod
+    def options(cls, fmt, quality):
+        '''options'''
+        return [x.format(quality=quality) for x in ENCODER_FORMATS[fmt]]
+
+    def start(self):
+        '''start'''
+        for i in range(self.__workers):
+            thread = threading.Thread(target=self.__worker,
+                                      name="encoder" + str(i), daemon=True)
+            thread.start()
+            self.__threads.append(thread)
+
+    def stop(self):
+        '''stop'''
+        for thread in self.__threads:
+            self.__queue.put(None)
+        for thread in self.__threads:
+            thread.join()
+        self.__threads = []
+
+    def __worker(self):
+        '''__worker'''
+        running = True
+        while running:
+            item = self.__queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.__batchtime
+            while len(batch) < self.__batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.__queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    running = False
+                    break
+                batch.append(item)
+            self.__encodebatch(batch)
+
+    def __command(self, batch):
+        '''__command'''
+        command = ["ffmpeg", "-nostdin", "-y"]
+        for src, dst, options, tags, metrics, future in batch:
+            command += ["-i", src]
+        for i, (src, dst, options, tags, metrics, future) in \
+                enumerate(batch):
+            command += ["-map", str(i) + ":a", "-map_metadata", "-1"]
+            for key in sorted(tags):
+                command += ["-metadata", key + "=" + tags[key]]
+            command += options + [dst + ".part"]
+        return command
+
+    def __record(self, batch, result):
+        '''__record'''
+        # A batch can mix the files of several jobs, each one is charged
+        # with its share of the command
+        owners = [x[4] for x in batch if x[4] is not None]
+        sample = dict(result.usage, wall=result.elapsed, wait=result.waited)
+        for metrics in set(owners):
+            share = owners.count(metrics) / len(batch)
+            metrics.record("command", os.path.basename(result.command[0]),
+                           {key: sample[key] * share for key in sample})
+
+    def __encodebatch(self, batch):
+        '''__encodebatch'''
+        try:
+            result = self.__run(self.__command(batch))
+        except Exception as e:
+            for src, dst, options, tags, metrics, future in batch:
+                future.set_exception(e)
+            return
+        self.__record(batch, result)
+        returncode = result.returncode
+        if returncode != 0 and len(batch) > 1:
+            logging.warning("Encoding a batch of " + str(len(batch)) +
+                            " files failed, retrying one at a time")
+            for job in batch:
+                self.__encodebatch([job])
+            return
+        for src, dst, options, tags, metrics, future in batch:
+            try:
+                if returncode == 0:
+                    os.replace(dst + ".part", dst)
+                elif os.path.exists(dst + ".part"):
+                    os.remove(dst + ".part")
+            except Exception as e:
+                future.set_exception(e)
+                continue
+            future.set_result(returncode)
+
+    def encode(self, src, dst, options, tags, metrics=None):
+        '''encode'''
+        future = Future()
+        self.__queue.put((src, dst, options, tags, metrics, future))
+        return future
+
+
+class Fingerprinter():
+    '''Fingerprinter'''
+    @classmethod
+    def __unpack(cls, data, width, count):
+        '''__unpack'''
+        bits = np.unpackbits(np.frombuffer(data, dtype=np.uint8),
+                             bitorder="little")
+        bits = bits[:len(bits) - len(bits) % width].reshape(-1, width)
+        weights = (1 << np.arange(width)).astype(np.int64)
+        return (bits * weights).sum(axis=1)[:count]
+
+    @classmethod
+    def decode(cls, encoded):
+        '''decode'''
+        if isinstance(encoded, bytes):
+            encoded = encoded.decode("ascii")
+        data = base64.urlsafe_b64decode(encoded + "=" * (-len(encoded) % 4))
+        algorithm = data[0]
+        length = (data[1] << 16) | (data[2] << 8) | data[3]
+        bits = cls.__unpack(data[4:], 3, None)
+        ends = np.flatnonzero(bits == 0)
+        if len(ends) < length:
+            raise ValueError("Truncated fingerprint")
+        bits = bits[:ends[length - 1] + 1] if length > 0 else bits[:0]
+        exceptional = np.flatnonzero(bits == 7)
+        offset = 4 + (len(bits) * 3 + 7) // 8
+        bits[exceptional] += cls.__unpack(data[offset:], 5,
+                                          len(exceptional))
+        zeros = bits == 0
+        items = np.cumsum(zeros) - zeros
+        totals = np.cumsum(bits)
+        positions = totals - np.concatenate(([0], totals[zeros]))[items]
+        values = np.zeros(length, dtype=np.uint64)
+        nonzero = bits != 0
+        np.add.at(values, items[nonzero],
+                  np.left_shift(np.uint64(1),
+                                (positions[nonzero] - 1).astype(np.uint64)))
+        raw = np.bitwise_xor.accumulate(values.astype(np.uint32))
+        return algorithm, raw
+
+    @classmethod
+    def fingerprint(cls, filename):
+        '''fingerprint'''
+        duration, encoded = acoustid.fingerprint_file(filename)
+        algorithm, raw = cls.decode(encoded)
+        return duration, encoded, algorithm, raw
+
+
+class FingerprintUnpickler(pickle.Unpickler):
+    '''FingerprintUnpickler'''
+    def find_class(self, module, name):
+        raise pickle.UnpicklingError("Refusing to load " + module + "." +
+                                     name + " from a fingerprint")
+
+
+class FingerprintIndex():
+    '''FingerprintIndex'''
+    def __init__(self, stride, similarity):
+        self.__stride = stride
+        self.__similarity = similarity
+        self.__songs = []
+        self.__prints = []
+        self.__runs = []
+        self.__lock = threading.Lock()
+
+    def __empty(self):
+        '''__empty'''
+        return (np.empty(0, dtype=np.uint32), np.empty(0, dtype=np.int32),
+                np.empty(0, dtype=np.int32))
+
+    def __sort(self, keys, ids, pos):
+        '''__sort'''
+        order = np.argsort(keys, kind="stable")
+        return keys[order], ids[order], pos[order]
+
+    def __merge(self, older, newer):
+        '''__merge'''
+        slots = np.searchsorted(older[0], newer[0], "right") + \
+            np.arange(len(newer[0]))
+        rest = np.ones(len(older[0]) + len(newer[0]), dtype=bool)
+        rest[slots] = False
+        merged = []
+        for a, b in zip(older, newer):
+            column = np.empty(len(rest), dtype=a.dtype)
+            column[slots] = b
+            column[rest] = a
+            merged.append(column)
+        return tuple(merged)
+
+    def add(self, song, raw):
+        '''add'''
+        with self.__lock:
+            sid = len(self.__songs)
+            self.__songs.append(song)
+            self.__prints.append(raw)
+            pos = np.arange(0, len(raw), self.__stride, dtype=np.int32)
+            self.__runs.append(self.__sort(
+                raw[pos] >> INDEX_SHIFT,
+                np.full(len(pos), sid, dtype=np.int32), pos))
+            # Sorted runs are merged while the newest is at least half the
+            # size of the previous one, so that there are O(log n) of them
+            # and each posting is merged O(log n) times
+            while len(self.__runs) > 1 and \
+                    2 * len(self.__runs[-1][0]) >= len(self.__runs[-2][0]):
+                newer = self.__runs.pop()
+                self.__runs[-1] = self.__merge(self.__runs[-1], newer)
+
+    def __lookup(self, index, keys):
+        '''__lookup'''
+        sortedkeys, ids, pos = index
+        left = np.searchsorted(sortedkeys, keys, "left")
+        counts = np.searchsorted(sortedkeys, keys, "right") - left
+        total = int(counts.sum())
+        firsts = np.repeat(np.cumsum(counts) - counts, counts)
+        postings = np.repeat(left, counts) + np.arange(total) - firsts
+        querypos = np.repeat(np.arange(len(keys), dtype=np.int64), counts)
+        return ids[postings], pos[postings] - querypos
+
+    def similarity(self, a, b, offset):
+        '''similarity'''
+        start = max(0, -offset)
+        end = min(len(a), len(b) - offset)
+        if end - start < min(len(a), len(b)) // 2 or end <= start:
+            return 0.0
+        diff = a[start:end] ^ b[start + offset:end + offset]
+        errors = np.unpackbits(diff.view(np.uint8)).sum()
+        return 1.0 - errors / (32.0 * (end - start))
+
+    def match(self, raw):
+        '''match'''
+        with self.__lock:
+            runs = list(self.__runs) or [self.__empty()]
+            songs = list(self.__songs)
+            prints = list(self.__prints)
+        keys = raw >> INDEX_SHIFT
+        results = [self.__lookup(run, keys) for run in runs]
+        ids = np.concatenate([x[0] for x in results]).astype(np.int64)
+        offsets = np.concatenate([x[1] for x in results]).astype(np.int64)
+        if len(ids) == 0:
+            return None
+        pairs, votes = np.unique((ids << 32) | (offsets + (1 << 31)),
+                                 return_counts=True)
+        best = None
+        for i in np.argsort(votes)[::-1][:INDEX_CANDIDATES]:
+            if votes[i] < INDEX_MIN_VOTES:
+                break
+            sid = int(pairs[i] >> 32)
+            offset = int(pairs[i] & 0xffffffff) - (1 << 31)
+            score = self.similarity(raw, prints[sid], offset)
+            if score >= self.__similarity and \
+               (best is None or score > best[1]):
+                best = (songs[sid], score)
+        return best
+
+
+class Resolver():
+    '''Resolver'''
+    def __init__(self, url, key, batch, rate, ttl, minscore, db):
+        self.__url = url
+        self.__key = key
+        self.__batch = batch
+        self.__interval = 1.0 / rate
+        self.__ttl = ttl
+        self.__minscore = minscore
+        self.__db = db
+        self.__queue = queue.Queue()
+        self.__last = 0.0
+        self.__thread = None
+
+    def start(self):
+        '''start'''
+        self.__thread = threading.Thread(target=self.__worker,
+                                         name="resolver", daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        '''stop'''
+        self.__queue.put(None)
+        self.__thread.join()
+
+    def lookup(self, duration, encoded):
+        '''lookup'''
+        future = Future()
+        self.__queue.put((int(duration), encoded, future))
+        return future
+
+    def __cachekey(self, duration, encoded):
+        '''__cachekey'''
+        digest = hashlib.sha1(encoded.encode("ascii")).hexdigest()
+        return digest + ":" + str(duration)
+
+    def __cached(self, key):
+        '''__cached'''
+        rows = self.__db.query('SELECT Response FROM Lookups ' +
+                               'WHERE Key == ? AND Fetched > ?',
+                               (key, time.time() - self.__ttl))
+        return json.loads(rows[0][0]) if rows else None
+
+    def __worker(self):
+        '''__worker'''
+        running = True
+        while running:
+            batch = []
+            item = self.__queue.get()
+            while item is not None:
+                cached = self.__cached(self.__cachekey(*item[:2]))
+                if cached is not None:
+                    item[2].set_result(self.__parse(cached))
+                else:
+                    batch.append(item)
+                if len(batch) >= self.__batch:
+                    break
+                try:
+                    item = self.__queue.get(timeout=RESOLVER_WAIT)
+                except queue.Empty:
+                    break
+            running = item is not None
+            if batch:
+                self.__resolve(batch)
+
+    def __request(self, batch):
+        '''__request'''
+        params = {"client": self.__key, "meta": "recordings",
+                  "format": "json"}
+        for i, (duration, encoded, future) in enumerate(batch):
+            params["duration." + str(i)] = str(duration)
+            params["fingerprint." + str(i)] = encoded
+        wait = self.__last + self.__interval - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        self.__last = time.monotonic()
+        with urlrequest.urlopen(self.__url, urlencode(params).encode("ascii"),
+                                timeout=RESOLVER_TIMEOUT) as response:
+            return json.loads(response.read().decode("utf-8"))
+
+    def __resolve(self, batch):
+        '''__resolve'''
+        try:
+            response = self.__request(batch)
+            if response.get("status") != "ok":
+                raise ValueError(str(response.get("error", response)))
+        except Exception as e:
+            logging.warning("AcoustID lookup failed: " + str(e))
+            for duration, encoded, future in batch:
+                future.set_result(None)
+            return
+        if "fingerprints" in response:
+            answers = {int(x["index"]): x.get("results", [])
+                       for x in response["fingerprints"]}
+        else:
+            answers = {0: response.get("results", [])}
+        for i, (duration, encoded, future) in enumerate(batch):
+            results = answers.get(i, [])
+            self.__db.write('INSERT OR REPLACE INTO ' +
+                            'Lookups(Key, Response, Fetched) ' +
+                            'VALUES(?, ?, ?)',
+                            (self.__cachekey(duration, encoded),
+                             json.dumps(results), time.time()))
+            future.set_result(self.__parse(results))
+
+    def __parse(self, results):
+        '''__parse'''
+        for result in sorted(results, key=lambda x: -x.get("score", 0)):
+            if result.get("score", 0) < self.__minscore:
+                break
+            for recording in result.get("recordings", []):
+                artists = [x["name"] for x in recording.get("artists", [])
+                           if x.get("name")]
+                if recording.get("title") and artists:
+                    return recording["title"], ", ".join(artists)
+        return None
+
+
+class Catalog():
+    '''Catalog'''
+    def __init__(self, songs):
+        self.__byin = {}
+        self.__bytitle = {}
+        self.__bymp3 = {}
+        self.__lock = threading.Lock()
+        for song in songs:
+            self.__byin[song["in"]] = song
+        for song in sorted([x for x in songs if self.__titled(x)],
+                           key=lambda x: (x["title"], x["artists"], x["in"])):
+            self.__index(song)
+
+    @classmethod
+    def assemblename(cls, title, artists, ext):
+        '''assemblename'''
+        return title + " _ " + artists + "." + ext
+
+    def __titled(self, song):
+        '''__titled'''
+        return song["title"] is not None and song["artists"] is not None
+
+    def __index(self, song):
+        '''__index'''
+        key = (song["title"], song["artists"])
+        owner = self.__bytitle.setdefault(key, song)
+        self.__bymp3.setdefault(
+            self.assemblename(song["title"], song["artists"], "mp3"), owner)
+
+    def __unindex(self, song):
+        '''__unindex'''
+        key = (song["title"], song["artists"])
+        if self.__bytitle.get(key, None) is not song:
+            return
+        others = [x for x in self.__byin.values() if x is not song and
+                  (x["title"], x["artists"]) == key]
+        name = self.assemblename(song["title"], song["artists"], "mp3")
+        if others:
+            owner = min(others, key=lambda x: x["in"])
+            self.__bytitle[key] = owner
+            if self.__bymp3.get(name, None) is song:
+                self.__bymp3[name] = owner
+            return
+        del self.__bytitle[key]
+        if self.__bymp3.get(name, None) is song:
+            del self.__bymp3[name]
+
+    def __contains__(self, filename):
+        return filename in self.__byin
+
+    def get(self, filename):
+        '''get'''
+        return self.__byin.get(filename, None)
+
+    def add(self, filename):
+        '''add'''
+        with self.__lock:
+            return self.__byin.setdefault(
+                filename, {"in": filename, "title": None, "artists": None})
+
+    def settitle(self, filename, title, artists):
+        '''settitle'''
+        with self.__lock:
+            song = self.__byin.setdefault(
+                filename, {"in": filename, "title": None, "artists": None})
+            if (song["title"], song["artists"]) == (title, artists):
+                return
+            if self.__titled(song):
+                self.__unindex(song)
+            song["title"] = title
+            song["artists"] = artists
+            self.__index(song)
+
+    def canonical(self, filename):
+        '''canonical'''
+        song = self.__byin.get(filename, None)
+        if song is None or not self.__titled(song):
+            return None
+        owner = self.__bytitle.get((song["title"], song["artists"]), None)
+        return song if owner is song else None
+
+    def mp3name(self, filename):
+        '''mp3name'''
+        song = self.__byin.get(filename, None)
+        if song is None or not self.__titled(song):
+            return None
+        return self.assemblename(song["title"], song["artists"], "mp3")
+
+    def bymp3(self, name):
+        '''bymp3'''
+        return self.__bymp3.get(name, None)
+
+
+class Schema():
+    '''Schema'''
+    @classmethod
+    def __version1(cls, con):
+        '''__version1'''
+        for statement in (
+                'Songs("Input File Name" TEXT PRIMARY KEY, ' +
+                'AcoustID BLOB, Title TEXT, Artists TEXT)',
+                'Playlists(Playlist TEXT PRIMARY KEY, Type TEXT, ' +
+                'Songs TEXT)',
+                'Cache(Key TEXT PRIMARY KEY, Size INTEGER, LastUsed REAL)',
+                'Conditioned(Name TEXT PRIMARY KEY, Key TEXT)',
+                'Fingerprints(Song TEXT PRIMARY KEY, Duration REAL, ' +
+                'Algorithm INTEGER, Data BLOB, Encoded TEXT, ' +
+                'DuplicateOf TEXT)',
+                'Lookups(Key TEXT PRIMARY KEY, Response TEXT, Fetched REAL)',
+                'DeviceFiles(Device TEXT, Name TEXT, Size INTEGER, ' +
+                'MTime INTEGER, Hash TEXT, PRIMARY KEY(Device, Name))',
+                'Files(Tree TEXT, Name TEXT, PRIMARY KEY(Tree, Name))',
+                'Downloads(Video TEXT PRIMARY KEY, Source TEXT, ' +
+                'Title TEXT, Added REAL)',
+                'PlaylistVideos(Playlist TEXT, Position INTEGER, ' +
+                'Video TEXT, PRIMARY KEY(Playlist, Position))',
+                'Tracks(Artifact TEXT PRIMARY KEY, Signature TEXT, ' +
+                'Status TEXT, Attempts INTEGER, Error TEXT, Updated REAL)',
+                'Journal(Artifact TEXT, Stage TEXT, Signature TEXT, ' +
+                'Data TEXT, PRIMARY KEY(Artifact, Stage))'):
+            con.execute('CREATE TABLE IF NOT EXISTS ' + statement)
+
+    @classmethod
+    def __version2(cls, con):
+        '''__version2'''
+        con.execute('CREATE TABLE PlaylistEntries(Playlist TEXT, ' +
+                    'Position INTEGER, Song TEXT, ' +
+                    'PRIMARY KEY(Playlist, Position))')
+        rows = con.execute('SELECT Playlist, Songs FROM Playlists ' +
+                           'WHERE Songs IS NOT NULL').fetchall()
+        for playlist, songs in rows:
+            try:
+                songs = ast.literal_eval(songs)
+            except (ValueError, SyntaxError):
+                logging.warning("Cannot migrate playlist " + playlist)
+                continue
+            con.executemany('INSERT INTO PlaylistEntries(Playlist, ' +
+                            'Position, Song) VALUES(?, ?, ?)',
+                            [(playlist, i, x) for i, x in enumerate(songs)])
+        con.execute('UPDATE Playlists SET Songs = NULL')
+
+    @classmethod
+    def __version3(cls, con):
+        '''__version3'''
+        for statement in (
+                'SongsByTitle ON Songs(Title, Artists)',
+                'EntriesBySong ON PlaylistEntries(Song)',
+                'VideosByVideo ON PlaylistVideos(Video)',
+                'FingerprintsByDuplicate ON Fingerprints(DuplicateOf)',
+                'CacheByLastUsed ON Cache(LastUsed)',
+                'TracksByStatus ON Tracks(Status)'):
+            con.execute('CREATE INDEX IF NOT EXISTS ' + statement)
+
+    @classmethod
+    def migrations(cls):
+        '''migrations'''
+        return [cls.__version1, cls.__version2, cls.__version3]
+
+    @classmethod
+    def migrate(cls, dbfile):
+        '''migrate'''
+        migrations = cls.migrations()
+        con = sqlite.connect(dbfile, isolation_level=None)
+        try:
+            version = con.execute('PRAGMA user_version').fetchone()[0]
+            if version > len(migrations):
+                raise RuntimeError(dbfile + " has schema version " +
+                                   str(version) + ", newer than " +
+                                   str(len(migrations)))
+            for number in range(version + 1, len(migrations) + 1):
+                logging.info("Migrating the DB to schema version " +
+                             str(number))
+                con.execute('BEGIN IMMEDIATE')
+                try:
+                    migrations[number - 1](con)
+                    con.execute('PRAGMA user_version = ' + str(number))
+                    con.execute('COMMIT')
+                except Exception:
+                    con.execute('ROLLBACK')
+                    raise
+        finally:
+            con.close()
+
+
+class Database():
+    '''Database'''
+    def __init__(self, dbfile, batchrows, batchtime, readers):
+        self.__dbfile = dbfile
+        self.__batchrows = batchrows
+        self.__batchtime = batchtime
+        self.__nreaders = readers
+        self.__queue = queue.Queue()
+        self.__readers = queue.Queue()
+        self.__thread = None
+
+    def start(self):
+        '''start'''
+        ready = Future()
+        self.__thread = threading.Thread(target=self.__writer, args=(ready,),
+                                         name="dbwriter", daemon=True)
+        self.__thread.start()
+        ready.result()
+        uri = "file:" + self.__dbfile + "?mode=ro"
+        for i in range(self.__nreaders):
+            self.__readers.put(sqlite.connect(uri, uri=True,
+                                              check_same_thread=False))
+
+    def stop(self):
+        '''stop'''
+        stopped = Future()
+        self.__queue.put((False, None, stopped))
+        stopped.result()
+        self.__thread.join()
+        while not self.__readers.empty():
+            self.__readers.get_nowait().close()
+
+    def __writer(self, ready):
+        '''__writer'''
+        try:
+            con = sqlite.connect(self.__dbfile)
+            con.execute("PRAGMA journal_mode=WAL")
+            con.execute("PRAGMA synchronous=NORMAL")
+        except Exception as e:
+            ready.set_exception(e)
+            return
+        ready.set_result(True)
+        running = True
+        while running:
+            batch = [self.__queue.get()]
+            deadline = time.monotonic() + self.__batchtime
+            while len(batch) < self.__batchrows and batch[-1][0]:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.__queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            running = self.__commit(con, batch)
+        con.close()
+
+    def __commit(self, con, batch):
+        '''__commit'''
+        results = []
+        try:
+            with con:
+                for sql, params, future in batch:
+                    if not sql:
+                        results.append((future, True))
+                        continue
+                    try:
+                        results.append((future,
+                                        con.execute(sql, params).rowcount))
+                    except sqlite.IntegrityError as e:
+                        results.append((future, e))
+        except Exception as e:
+            logging.error("DB transaction failed: " + str(e))
+            results = [(future, e) for sql, params, future in batch]
+        logging.debug("Committed " + str(len(batch)) + " DB operations")
+        for future, result in results:
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+        return batch[-1][0] is not False
+
+    def write(self, sql, params=()):
+        '''write'''
+        future = Future()
+        self.__queue.put((sql, params, future))
+        return future
+
+    def flush(self):
+        '''flush'''
+        future = Future()
+        self.__queue.put((None, None, future))
+        return future.result()
+
+    def query(self, sql, params=()):
+        '''query'''
+        con = self.__readers.get()
+        try:
+            return con.execute(sql, params).fetchall()
+        finally:
+            self.__readers.put(con)
+
+
+class Journal():
+    '''Journal'''
+    def __init__(self, db):
+        self.__db = db
+        self.__lock = threading.Lock()
+        self.__entries = {(x[0], x[1]): (x[2], x[3])
+                          for x in db.query('SELECT Artifact, Stage, ' +
+                                            'Signature, Data FROM Journal')}
+
+    def signature(self, *parts):
+        '''signature'''
+        return json.dumps(parts)
+
+    def stat(self, path):
+        '''stat'''
+        st = os.stat(path)
+        return [st.st_size, st.st_mtime_ns]
+
+    def get(self, artifact, stage):
+        '''get'''
+        with self.__lock:
+            return self.__entries.get((artifact, stage), (None, None))
+
+    def done(self, artifact, stage, signature):
+        '''done'''
+        return self.get(artifact, stage)[0] == signature
+
+    def mark(self, artifact, stage, signature, data=None):
+        '''mark'''
+        with self.__lock:
+            self.__entries[(artifact, stage)] = (signature, data)
+        self.__db.write('INSERT OR REPLACE INTO Journal(Artifact, Stage, ' +
+                        'Signature, Data) VALUES(?, ?, ?, ?)',
+                        (artifact, stage, signature, data))
+
+    def move(self, moves):
+        '''move'''
+        with self.__lock:
+            for key in [x for x in self.__entries if x[0] in moves]:
+                self.__entries[(moves[key[0]], key[1])] = \
+                    self.__entries.pop(key)
+        for old, new in moves.items():
+            self.__db.write('UPDATE Journal SET Artifact = ? ' +
+                            'WHERE Artifact == ?', (new, old))
+
+
+class Tracker():
+    '''Tracker'''
+    def __init__(self, db, quarantine):
+        self.__db = db
+        self.__quarantine = quarantine
+        self.__lock = threading.Lock()
+        self.__entries = {x[0]: tuple(x[1:])
+                          for x in db.query('SELECT Artifact, Signature, ' +
+                                            'Status, Attempts FROM Tracks')}
+
+    @classmethod
+    def permanent(cls, error):
+        '''permanent'''
+        if isinstance(error, StageError):
+            return error.permanent
+        return isinstance(error, mutagen.MutagenError)
+
+    def quarantined(self, artifact, signature):
+        '''quarantined'''
+        with self.__lock:
+            entry = self.__entries.get(artifact, (None, None, 0))
+        return entry[:2] == (signature, "quarantined")
+
+    def __store(self, artifact, signature, status, attempts, error):
+        '''__store'''
+        self.__db.write('INSERT OR REPLACE INTO Tracks(Artifact, ' +
+                        'Signature, Status, Attempts, Error, Updated) ' +
+                        'VALUES(?, ?, ?, ?, ?, ?)',
+                        (artifact, signature, status, attempts, error,
+                         time.time()))
+
+    def succeeded(self, artifact, signature):
+        '''succeeded'''
+        with self.__lock:
+            if self.__entries.get(artifact) == (signature, "done", 0):
+                return
+            self.__entries[artifact] = (signature, "done", 0)
+        self.__store(artifact, signature, "done", 0, None)
+
+    def failed(self, artifact, signature, error):
+        '''failed'''
+        with self.__lock:
+            entry = self.__entries.get(artifact, (None, None, 0))
+            attempts = 1
+            if entry[:2] == (signature, "failed"):
+                attempts += entry[2]
+            status = "failed"
+            if self.permanent(error) or attempts >= self.__quarantine:
+                status = "quarantined"
+            self.__entries[artifact] = (signature, status, attempts)
+        self.__store(artifact, signature, status, attempts,
+                     type(error).__name__ + ": " + str(error))
+        return status
+
+
+class Cache():
+    '''Cache'''
+    def __init__(self, path, maxsize, db):
+        self.__path = path
+        self.__maxsize = maxsize
+        self.__db = db
+        self.__locks = {}
+        self.__lock = threading.Lock()
+
+    @classmethod
+    def hashfile(cls, src):
+        '''hashfile'''
+        digest = hashlib.sha256()
+        with open(src, "rb") as infile:
+            for block in iter(partial(infile.read, 1 << 20), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def key(self, contenthash, params):
+        '''key'''
+        digest = hashlib.sha256(contenthash.encode("ascii"))
+        digest.update(json.dumps(params, sort_keys=True).encode("utf-8"))
+        return digest.hexdigest()
+
+    def lock(self, key):
+        '''lock'''
+        with self.__lock:
+            if key not in self.__locks:
+                self.__locks[key] = threading.Lock()
+            return self.__locks[key]
+
+    def path(self, key):
+        '''path'''
+        return os.path.join(self.__path, key[:2], key + ".ogg")
+
+    def lookup(self, key):
+        '''lookup'''
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        self.__db.write('UPDATE Cache SET LastUsed = ? WHERE Key == ?',
+                        (time.time(), key))
+        return path
+
+    def prepare(self, key):
+        '''prepare'''
+        os.makedirs(os.path.dirname(self.path(key)), exist_ok=True)
+        return self.path(key)
+
+    def add(self, key):
+        '''add'''
+        self.__db.write('INSERT OR REPLACE INTO Cache(Key, Size, LastUsed) ' +
+                        'VALUES(?, ?, ?)',
+                        (key, os.path.getsize(self.path(key)), time.time()))
+
+    def materialize(self, key, dst):
+        '''materialize'''
+        Materializer.materialize(self.path(key), dst)
+
+    def evict(self):
+        '''evict'''
+        if self.__maxsize <= 0:
+            return
+        total = 0
+        for key, size in self.__db.query('SELECT Key, Size FROM Cache ' +
+                                         'ORDER BY LastUsed DESC'):
+            try:
+                links = os.stat(self.path(key)).st_nlink
+            except FileNotFoundError:
+                self.__db.write('DELETE FROM Cache WHERE Key == ?', (key,))
+                continue
+            # Entries hard linked into normalized free no space when
+            # removed, only the orphaned ones count against the limit
+            if links > 1:
+                continue
+            total += size
+            if total <= self.__maxsize:
+                continue
+            logging.info("Evicting " + key + " from the cache")
+            os.remove(self.path(key))
+            self.__db.write('DELETE FROM Cache WHERE Key == ?', (key,))
+        self.__db.flush()
+
+
+class Layout():
+    '''Layout'''
+    def __init__(self, tree, root, db, journal):
+        self.tree = tree
+        self.root = root
+        self.__db = db
+        self.__journal = journal
+        self.__names = set()
+        self.__shards = set()
+        self.__lock = threading.Lock()
+
+    @classmethod
+    def shard(cls, filename):
+        '''shard'''
+        return hashlib.sha1(filename.encode("utf-8")).hexdigest()[:SHARD_WIDTH]
+
+    def path(self, filename):
+        '''path'''
+        return os.path.join(self.root, self.shard(filename), filename)
+
+    def prepare(self, filename):
+        '''prepare'''
+        shard = self.shard(filename)
+        if shard not in self.__shards:
+            os.makedirs(os.path.join(self.root, shard), exist_ok=True)
+            self.__shards.add(shard)
+        return self.path(filename)
+
+    def __contains__(self, filename):
+        return filename in self.__names
+
+    def names(self):
+        '''names'''
+        with self.__lock:
+            return sorted(self.__names)
+
+    def add(self, filename):
+        '''add'''
+        with self.__lock:
+            if filename in self.__names:
+                return
+            self.__names.add(filename)
+        self.__db.write('INSERT OR IGNORE INTO Files(Tree, Name) ' +
+                        'VALUES(?, ?)', (self.tree, filename))
+
+    def remove(self, filename):
+        '''remove'''
+        with self.__lock:
+            self.__names.discard(filename)
+        if os.path.exists(self.path(filename)):
+            os.remove(self.path(filename))
+        self.__db.write('DELETE FROM Files WHERE Tree == ? AND Name == ?',
+                        (self.tree, filename))
+
+    def load(self):
+        '''load'''
+        os.makedirs(self.root, exist_ok=True)
+        self.__names = set(x[0] for x in self.__db.query(
+            'SELECT Name FROM Files WHERE Tree == ?', (self.tree,)))
+        flat = [x.name for x in os.scandir(self.root)
+                if x.is_file() and not x.name.endswith(".part")]
+        if flat:
+            logging.info("Moving " + str(len(flat)) + " files of " +
+                         self.tree + " to the sharded layout")
+        moves = {}
+        for filename in flat:
+            src = os.path.join(self.root, filename)
+            moves[src] = self.prepare(filename)
+            os.replace(src, moves[src])
+            self.add(filename)
+        self.__journal.move(moves)
+        if not self.__names:
+            for shard in os.scandir(self.root):
+                if shard.is_dir() and len(shard.name) == SHARD_WIDTH:
+                    for entry in os.scandir(shard.path):
+                        if not entry.name.endswith(".part"):
+                            self.add(entry.name)
+        self.__db.flush()
+
+
+class Config():
+    '''Config'''
+    def __init__(self, cfgpath=CFG_PATH):
+        self.cfgpath = cfgpath
+
+    def __preparepaths(self, cfgpath, basepath):
+        '''__preparepaths'''
+        self.paths = {}
+        self.paths["cfg"] = cfgpath
+        self.paths["basepath"] = basepath
+        self.paths["downloads"] = os.path.join(basepath, "downloads")
+        self.paths["store"] = os.path.join(basepath, "store")
+        self.paths["incoming"] = os.path.join(self.paths["store"],
+                                              "incoming")
+        self.paths["normalized"] = os.path.join(basepath, "normalized")
+        self.paths["encoded"] = os.path.join(basepath, "encoded")
+        self.paths["mp3"] = os.path.join(basepath, "mp3")
+        self.paths["pls"] = os.path.join(basepath, "playlists")
+        self.paths["custom"] = os.path.join(basepath, "custom")
+        self.paths["devices"] = os.path.join(basepath, "devices")
+        self.paths["cache"] = os.path.join(basepath, "cache")
+
+    def inpath(self, path, filename):
+        '''inpath'''
+        return os.path.join(self.paths[path], filename)
+
+    def __loadbaseconfig(self):
         '''__loadbaseconfig'''
         try:
             parser = ConfigParser()
-            cfgfile = os.path.join(CFG_PATH, "syphon.ini")
+            cfgfile = os.path.join(self.cfgpath, "syphon.ini")
             parser.read(cfgfile)
-            cls.__gain = parser.getint("GLOBAL", "TARGET_GAIN")
-            cls.threads = parser.getint("GLOBAL", "MAX_THREADS")
+            self.gain = parser.getint("GLOBAL", "TARGET_GAIN")
+            self.threads = parser.getint("GLOBAL", "MAX_THREADS")
             basepath = os.path.expanduser(parser.get("GLOBAL", "BASE_PATH"))
-            cls.__preparepaths(CFG_PATH, basepath)
+            self.__loadworkersconfig(parser)
+            self.__loadschedulerconfig(parser)
+            self.__loaddatabaseconfig(parser)
+            self.__loadencoderconfig(parser)
+            self.__loadmetricsconfig(parser, basepath)
+            self.__loaddaemonconfig(parser, basepath)
+            self.__loadretryconfig(parser)
+            self.__loaddownloadconfig(parser)
+            self.cachesize = parser.getint("CACHE", "MAX_SIZE",
+                                           fallback=0) * 1024 * 1024
+            self.similarity = parser.getfloat("FINGERPRINT", "SIMILARITY",
+                                              fallback=0.85)
+            self.indexstride = parser.getint("FINGERPRINT", "INDEX_STRIDE",
+                                             fallback=4)
+            self.__loadacoustidconfig(parser)
+            self.__preparepaths(self.cfgpath, basepath)
+            self.dbfile = self.inpath("cfg", "syphon.db")
+            self.logpath = self.inpath("basepath", "syphon.log")
             return True
         except Exception:
             print("Error while parsing " + cfgfile)
             return False
 
-    @classmethod
-    def __loadkeyconfig(cls):
+    def __loadworkersconfig(self, parser):
+        '''__loadworkersconfig'''
+        self.workers = {}
+        for stage in STAGES:
+            workers = parser.getint("WORKERS", stage.upper(), fallback=0)
+            self.workers[stage] = workers if workers > 0 else self.threads
+        self.processstages = parser.get(
+            "WORKERS", "PROCESS_STAGES",
+            fallback=" ".join(PROCESS_STAGES)).split()
+        for stage in self.processstages:
+            if stage not in PROCESS_STAGES:
+                raise ValueError(stage + " cannot run in a process pool")
+
+    def __loadschedulerconfig(self, parser):
+        '''__loadschedulerconfig'''
+        self.maxcommands = parser.getint("SCHEDULER", "MAX_COMMANDS",
+                                         fallback=0) or self.threads
+        self.maxdownloads = parser.getint("SCHEDULER", "MAX_DOWNLOADS",
+                                          fallback=4)
+        self.maxperhost = parser.getint("SCHEDULER", "MAX_PER_HOST",
+                                        fallback=2)
+        self.maxlines = parser.getint("SCHEDULER", "OUTPUT_LINES",
+                                      fallback=200)
+
+    def __loaddatabaseconfig(self, parser):
+        '''__loaddatabaseconfig'''
+        self.batchrows = parser.getint("DATABASE", "BATCH_ROWS",
+                                       fallback=500)
+        self.batchtime = parser.getint("DATABASE", "BATCH_MS",
+                                       fallback=200) / 1000.0
+        self.dbreaders = parser.getint("DATABASE", "READERS",
+                                       fallback=0) or self.threads
+
+    def __loadencoderconfig(self, parser):
+        '''__loadencoderconfig'''
+        self.library = ("mp3", parser.get("ENCODER", "QUALITY",
+                                          fallback=ENCODER_QUALITY["mp3"]))
+        self.encodebatch = parser.getint("ENCODER", "BATCH", fallback=8)
+        self.encodetime = parser.getint("ENCODER", "BATCH_MS",
+                                        fallback=500) / 1000.0
+
+    def __loadmetricsconfig(self, parser, basepath):
+        '''__loadmetricsconfig'''
+        self.reportpath = parser.get("METRICS", "REPORT",
+                                     fallback="report.json")
+        if self.reportpath:
+            self.reportpath = os.path.join(
+                basepath, os.path.expanduser(self.reportpath))
+        self.prometheuspath = os.path.expanduser(
+            parser.get("METRICS", "PROMETHEUS", fallback=""))
+
+    def __loaddaemonconfig(self, parser, basepath):
+        '''__loaddaemonconfig'''
+        socket = parser.get("DAEMON", "SOCKET", fallback="syphon.sock")
+        self.daemon = {
+            "interval": parser.getfloat("DAEMON", "INTERVAL",
+                                        fallback=0) * 60,
+            "watch": parser.getboolean("DAEMON", "WATCH_CUSTOM",
+                                       fallback=True),
+            "socket": socket and os.path.join(basepath,
+                                              os.path.expanduser(socket)),
+            }
+
+    def __loaddownloadconfig(self, parser):
+        '''__loaddownloadconfig'''
+        self.download = {
+            "format": parser.get("DOWNLOAD", "FORMAT",
+                                 fallback="bestaudio/best"),
+            "audioformat": parser.get("DOWNLOAD", "AUDIO_FORMAT",
+                                      fallback="best"),
+            "cleanvideos": parser.getboolean("DOWNLOAD", "CLEAN_VIDEOS",
+                                             fallback=True),
+            "batch": max(1, parser.getint("DOWNLOAD", "BATCH",
+                                          fallback=10)),
+            }
+
+    def __loadretryconfig(self, parser):
+        '''__loadretryconfig'''
+        self.retry = {
+            "attempts": max(1, parser.getint("RETRY", "ATTEMPTS",
+                                             fallback=3)),
+            "backoff": parser.getfloat("RETRY", "BACKOFF", fallback=2),
+            "quarantine": max(1, parser.getint("RETRY", "QUARANTINE",
+                                               fallback=3)),
+            }
+
+    def __loadacoustidconfig(self, parser):
+        '''__loadacoustidconfig'''
+        self.acoustid = {
+            "enabled": parser.getboolean("ACOUSTID", "ENABLED",
+                                         fallback=True),
+            "url": parser.get("ACOUSTID", "URL", fallback=ACOUSTID_URL),
+            "batch": parser.getint("ACOUSTID", "BATCH", fallback=20),
+            "rate": parser.getfloat("ACOUSTID", "RATE", fallback=3),
+            "ttl": parser.getfloat("ACOUSTID", "TTL", fallback=30) * 86400,
+            "minscore": parser.getfloat("ACOUSTID", "MIN_SCORE",
+                                        fallback=0.8),
+            }
+
+    def __loadkeyconfig(self):
         '''__loadkeyconfig'''
         try:
             parser = ConfigParser()
-            cfgfile = cls.__inpath("cfg", "syphon_key.ini")
+            cfgfile = self.inpath("cfg", "syphon_key.ini")
             parser.read(cfgfile)
-            cls.key = parser.get("KEY", "VALUE")
+            self.key = parser.get("KEY", "VALUE")
             return True
         except Exception:
             print("Error while parsing " + cfgfile)
             return False
 
-    @classmethod
-    def __loadplaylistsconfig(cls):
+    def __loadplaylistsconfig(self):
         '''__loadplaylistsconfig'''
         try:
             parser = ConfigParser()
-            cfgfile = cls.__inpath("cfg", "syphon_urls.ini")
+            cfgfile = self.inpath("cfg", "syphon_urls.ini")
             parser.read(cfgfile)
-            cls.__playlists = []
+            self.playlists = []
             for section in parser.sections():
                 if parser.getboolean(section, "ACTIVE"):
-                    cls.__playlists.append({
+                    self.playlists.append({
                         "name": section,
                         "type": "auto",
                         "url": parser.get(section, "URL"),
-                        "path": cls.__inpath("downloads", section),
+                        "path": self.inpath("downloads", section),
                         })
             return True
         except Exception:
             print("Error while parsing " + cfgfile)
             return False
 
-    @classmethod
-    def __loaddevicesconfig(cls):
+    def __loaddevicesconfig(self):
         '''__loaddevicesconfig'''
         try:
             parser = ConfigParser()
-            cfgfile = cls.__inpath("cfg", "syphon_devices.ini")
+            cfgfile = self.inpath("cfg", "syphon_devices.ini")
             parser.read(cfgfile)
-            cls.__devices = []
+            self.devices = []
             for section in parser.sections():
-                cls.__devices.append({
+                fmt = parser.get(section, "FORMAT", fallback=self.library[0])
+                if fmt not in ENCODER_FORMATS:
+                    raise ValueError(fmt + " is not supported")
+                # The library quality is on the mp3 scale, other formats
+                # fall back to their own default
+                quality = self.library[1] if fmt == self.library[0] \
+                    else ENCODER_QUALITY[fmt]
+                profile = (fmt, parser.get(section, "QUALITY",
+                                           fallback=quality))
+                self.devices.append({
                     "name": section.lower(),
-                    "playlists": parser.get(section, "PLAYLISTS").split()
+                    "playlists": parser.get(section, "PLAYLISTS").split(),
+                    "ioworkers": parser.getint(section, "IO_WORKERS",
+                                               fallback=2),
+                    "profile": profile,
+                    "sharded": parser.getboolean(section, "SHARDED",
+                                                 fallback=False),
                     })
             return True
         except Exception:
             print("Error while parsing " + cfgfile)
             return False
 
-    @classmethod
-    def __loadconfigs(cls):
-        '''__loadconfigs'''
-        return (cls.__loadbaseconfig() and
-                cls.__loadkeyconfig() and
-                cls.__loadplaylistsconfig() and
-                cls.__loaddevicesconfig() and
+    def load(self):
+        '''load'''
+        return (self.__loadbaseconfig() and
+                self.__loadkeyconfig() and
+                self.__loadplaylistsconfig() and
+                self.__loaddevicesconfig() and
                 True)
 
+
+class ControlHandler(StreamRequestHandler):
+    '''ControlHandler'''
+    def handle(self):
+        '''handle'''
+        words = self.rfile.readline().decode("utf-8", "replace").split()
+        if not words or words[0] not in DAEMON_COMMANDS:
+            reply = {"error": "commands: " + " ".join(DAEMON_COMMANDS)}
+        else:
+            try:
+                reply = self.server.trigger(words[0], words[1:])
+            except Exception as e:
+                reply = {"error": str(e)}
+        self.wfile.write((json.dumps(reply) + "\n").encode("utf-8"))
+
+
+class Job():
+    '''Job'''
+    def __init__(self, playlists, devices, sweep, stages=PIPELINE_STAGES,
+                 names=None):
+        self.playlists = playlists
+        self.devices = devices
+        self.sweep = sweep
+        self.stages = stages
+        self.names = names
+        self.metrics = Metrics()
+        self.submitted = set()
+        self.submitlock = threading.Lock()
+        self.trackfutures = []
+
+
+class Syphon():
+    '''Syphon'''
     @classmethod
-    def __initlogger(cls, logfile="log.log", mainlevel=logging.DEBUG,
-                     filelevel=logging.DEBUG, consolelevel=logging.DEBUG):
-        '''__initlogger'''
+    def initlogger(cls, logpath, mainlevel=logging.DEBUG,
+                   filelevel=logging.DEBUG, consolelevel=logging.DEBUG):
+        '''initlogger'''
         # create logger
         logger = logging.getLogger()
         logger.setLevel(mainlevel)
         # create file handler which logs even debug messages
-        fh = logging.FileHandler(cls.__inpath("basepath", logfile))
+        fh = logging.FileHandler(logpath)
         fh.setLevel(filelevel)
         # create console handler also logging at DEBUG level
         ch = logging.StreamHandler()
         ch.setLevel(consolelevel)
         # create formatter and add it to the handlers
-        formatter = logging.Formatter("%(asctime)s [%(threadName)-12.12s] " +
+        formatter = logging.Formatter("%(asctime)s [%(processName)-12.12s] " +
+                                      "[%(threadName)-12.12s] " +
                                       "[%(levelname)-5.5s]  %(message)s")
         fh.setFormatter(formatter)
         ch.setFormatter(formatter)
@@ -156,524 +2053,1227 @@ class Syphon():
         logger.addHandler(fh)
         logger.addHandler(ch)
 
-    @classmethod
-    def __init__(cls):
-        if not cls.__loadconfigs():
-            exit(-1)
-        cls.__dbfile = cls.__inpath("cfg", "syphon.db")
-        cls.__processed_files = 0
-        cls.__con = 0
-        cls.__found = False
-        cls.acoustids = 0
-        cls.__initlogger(logfile="syphon.log", consolelevel=logging.WARNING)
+    def __init__(self, config):
+        self.__config = config
+        self.__locks = {}
+        self.__lockslock = threading.Lock()
+        # The log lives under BASE_PATH, which a first run has not created
+        os.makedirs(os.path.dirname(config.logpath), exist_ok=True)
+        self.initlogger(config.logpath, consolelevel=logging.WARNING)
 
-    @classmethod
-    def __logcommand(cls, command=[""]):
+    def __inpath(self, path, filename):
+        '''__inpath'''
+        return self.__config.inpath(path, filename)
+
+    def __logcommand(self, command=[""]):
         '''__logcommand'''
         if not isinstance(command, list) or command == [""]:
-            return "", "", -1
-        logging.info("Command:\n" + " ".join(command) + "\n")
-        proc = Popen(command, stdin=PIPE, stdout=PIPE, stderr=PIPE)
-        output, err = proc.communicate()
-        output = output.decode("utf-8")
-        err = err.decode("utf-8")
-        logging.info("Output:\n" + output + "\n")
-        logging.info("Error:\n" + err + "\n")
-        logging.info("Return Code:\n" + str(proc.returncode) + "\n")
-        return output, err, proc.returncode
+            return CommandResult(command=command, returncode=-1, output="",
+                                 err="", elapsed=0.0, waited=0.0,
+                                 progress={}, usage={})
+        return self.__scheduler.run(command)
 
-    @classmethod
-    def __downloadnewsongs(cls):
-        '''__downloadnewsongs'''
-        c = ['youtube-dl', '-i', '--download-archive', 'Archive.txt',
-             '--extract-audio', '--audio-format', 'vorbis', '--keep-video',
-             '-o', '%(playlist_index)s-%(title)s.%(ext)s',
-             cls.__playlist["url"]]
-        output, err, retcode = cls.__logcommand(c)
+    def __gethost(self, url):
+        '''__gethost'''
+        url = url.strip("'\"")
+        if "://" not in url:
+            url = "//" + url
+        return urlparse(url).hostname
 
-    @classmethod
-    def __getgain(cls, filename):
-        '''__getgain'''
-        logging.info("Extracting gain info.\n")
-        command = ['normalize-ogg', '-n', filename]
-        output, err, retcode = cls.__logcommand(command)
-        if "dBFS" in output:
-            level = output.split()[0]
-            logging.debug("Level: " + level)
-            level = level.split("dBFS")[0]
-            level = level.replace(',', '.')
-        elif "ADJUST_NEEDED 0" in output:
-            level = cls.__gain
-        return int(round(float(level)))
-
-    @classmethod
-    def __getbitrate(cls, filename):
-        '''__getbitrate'''
-        logging.info("Extracting average bitrate.\n")
-        command = ['exiftool', filename]
-        output, err, retcode = cls.__logcommand(command)
-        bitrate = 0
-        for line in output.split('\n'):
-            if 'Nominal Bitrate' in line:
-                bitrate = line.split(':')[1].split()[0]
-                break
-        logging.info("Average bitrate is: " + str(bitrate) + "\n")
-        return bitrate
+    def __onlistingline(self, videos, line):
+        '''__onlistingline'''
+        if not line.startswith("{"):
+            return
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            return
+        if "id" not in entry:
+            return
+        ie = entry.get("ie_key") or "generic"
+        url = entry.get("url") or entry["id"]
+        if "://" not in url and ie == "Youtube":
+            url = YOUTUBE_URL + url
+        videos.append({"key": ie.lower() + " " + entry["id"],
+                       "id": entry["id"], "url": url,
+                       "title": entry.get("title") or entry["id"]})
 
-    @classmethod
-    def __adjustgain(cls, filename, delta, bitrate):
-        '''__adjustgain'''
-        filename = cls.__inpath("normalized", filename)
-        logging.info("Re-normalizing.\n")
-        command = ['normalize-ogg', '--ogg', '--bitrate', bitrate,
-                   '-g', str(delta) + 'db', filename]
-        output, err, retcode = cls.__logcommand(command)
-        if retcode:
-            logging.critical("Re-normalizing failed.\n" +
-                             "Output:\n" + output + "err:\n" + err)
-            exit(retcode)
-
-    @classmethod
-    def __normalizegain(cls, filename):
-        '''__normalizegain'''
-        bitrate = cls.__getbitrate(filename)
-        if bitrate is 0:
-            logging.error("No bitrate found, aborting conversion.\n")
-            exit(-1)
-        adjusted_file = "_" + filename
-        copy2(filename, cls.__inpath("normalized", adjusted_file))
-        delta_gain = cls.__gain - cls.__getgain(filename)
-        if delta_gain is 0:
-            logging.info(filename + " is already at the correct level")
+    def __listplaylist(self, job, playlist):
+        '''__listplaylist'''
+        playlist["listing"] = []
+        c = ['youtube-dl', '-i', '--flat-playlist', '-j', playlist["url"]]
+        return self.__scheduler.submit(
+            c, host=self.__gethost(playlist["url"]),
+            online=partial(self.__onlistingline, playlist["listing"]),
+            metrics=job.metrics)
+
+    def __ondownloadline(self, job, chunk, stored, line):
+        '''__ondownloadline, runs on the scheduler loop so it only parses'''
+        if not line.startswith(DOWNLOADED + " "):
+            return
+        filename = os.path.basename(line[len(DOWNLOADED) + 1:])
+        stem, ext = os.path.splitext(filename)
+        if ext not in AUDIO_EXTENSIONS or stem not in chunk:
+            return
+        stored.append(self.__trackexecutor.submit(
+            self.__storedownload, job, filename, chunk[stem]))
+
+    def __storedownload(self, job, filename, video):
+        '''__storedownload'''
+        name = video["key"].replace(" ", "-") + os.path.splitext(filename)[1]
+        dst = self.__store.prepare(name)
+        os.replace(os.path.join(self.__config.paths["incoming"], filename),
+                   dst)
+        self.__store.add(name)
+        self.__archive(video["key"], dst, video["title"])
+        self.__submittracks(job, [dst])
+
+    def __settledownload(self, download, stored, command):
+        '''__settledownload'''
+        try:
+            errors = [x.exception() for x in [command] + stored]
+        except CancelledError:
+            download.cancel()
+            return
+        errors = [x for x in errors if x is not None]
+        if errors:
+            download.set_exception(errors[0])
         else:
-            logging.info("Required adjustment: " + str(delta_gain) + "\n")
-            cls.__adjustgain(adjusted_file, delta_gain, bitrate)
-        return adjusted_file
+            download.set_result(command.result())
 
-    @classmethod
-    def __trimstartsilence(cls, src, dst):
-        '''trimsilences'''
-        logging.info("Trimming silences.\n")
-        silences_from_start = "1"
-        max_silence_duration = "120"
-        silence_threshold = "2%"
-        command = ["sox", src, dst,
-                   "silence", silences_from_start, max_silence_duration,
-                   silence_threshold]
-        output, err, retcode = cls.__logcommand(command)
-        if retcode:
-            logging.critical("Trimming failed.\n" +
-                             "Output:\n" + output + "err:\n" + err)
-            exit(retcode)
-
-    @classmethod
-    def __reverse(cls, src, dst):
-        '''__reverse'''
-        logging.info("Reversing.\n")
-        command = ["sox", src, dst, "reverse"]
-        output, err, retcode = cls.__logcommand(command)
-        if retcode:
-            logging.critical("Reversing failed.\n" +
-                             "Output:\n" + output +
-                             "err:\n" + err)
-            exit(retcode)
-
-    @classmethod
-    def __do_op_tmp(cls, op, filename):
-        '''__do_op_tmp'''
-        src = cls.__inpath("normalized", filename)
-        dst = cls.__inpath("normalized", "_" + filename)
-        op(src, dst)
-        command = ["mv", dst, src]
-        output, err, retcode = cls.__logcommand(command)
-        return retcode
-
-    @classmethod
-    def __trimsilences(cls, filename):
-        '''trimsilences'''
-        cls.__do_op_tmp(cls.__trimstartsilence, filename)
-        cls.__do_op_tmp(cls.__reverse, filename)
-        cls.__do_op_tmp(cls.__trimstartsilence, filename)
-        cls.__do_op_tmp(cls.__reverse, filename)
-
-    @classmethod
-    def __condition(cls, filename):
+    def __downloadnewsongs(self, job, chunk):
+        '''__downloadnewsongs'''
+        urls = [x["url"] for x in chunk.values()]
+        c = ['youtube-dl', '-i',
+             '-f', self.__config.download["format"], '--extract-audio',
+             '--audio-format', self.__config.download["audioformat"],
+             '--exec', 'echo ' + DOWNLOADED + ' {}',
+             '-o', '%(id)s.%(ext)s'] + urls
+        # The download settles once every file it produced is in the store
+        stored = []
+        download = Future()
+        command = self.__scheduler.submit(
+            c, host=self.__gethost(urls[0]),
+            cwd=self.__config.paths["incoming"],
+            online=partial(self.__ondownloadline, job, chunk, stored),
+            metrics=job.metrics)
+        command.add_done_callback(partial(self.__trackexecutor.submit,
+                                          self.__settledownload, download,
+                                          stored))
+        return download
+
+    def __archive(self, key, source, title):
+        '''__archive'''
+        with self.__downloadslock:
+            self.__downloads[key] = source
+        self.__db.write('INSERT OR REPLACE INTO Downloads(Video, Source, ' +
+                        'Title, Added) VALUES(?, ?, ?, ?)',
+                        (key, os.path.relpath(
+                            source, self.__config.paths["basepath"]),
+                         title, time.time()))
+
+    def __loaddownloads(self):
+        '''__loaddownloads'''
+        self.__downloads = {
+            x[0]: os.path.join(self.__config.paths["basepath"], x[1])
+            for x in self.__db.query('SELECT Video, Source FROM Downloads')}
+        self.__downloadslock = threading.Lock()
+        self.__inflight = {}
+
+    def __conditionparams(self):
+        '''__conditionparams'''
+        return {"gain": self.__config.gain, "duration": SILENCE_DURATION,
+                "threshold": SILENCE_THRESHOLD, "window": SILENCE_WINDOW,
+                "version": CONDITIONER_VERSION}
+
+    def __trackname(self, src):
+        '''__trackname'''
+        return os.path.splitext(os.path.basename(src))[0] + ".ogg"
+
+    def __condition(self, job, src):
         '''__condition'''
-        logging.info("Conditioning " + filename)
-        filename = cls.__normalizegain(filename)
-        cls.__trimsilences(filename)
-        cmd = ["mv", cls.__inpath("normalized", filename),
-               cls.__inpath("normalized", filename[1:])]
-        output, err, retcode = cls.__logcommand(cmd)
-        return retcode
+        filename = self.__trackname(src)
+        dst = self.__normalized.prepare(filename)
+        signature = self.__journal.signature(self.__journal.stat(src),
+                                             self.__conditionparams())
+        if self.__journal.done(src, "condition", signature) and \
+           filename in self.__normalized:
+            return
+        key = self.__cache.key(self.__contenthash(src),
+                               self.__conditionparams())
+        with self.__conditionedlock:
+            conditioned = self.__conditioned.get(filename, None)
+        if conditioned == key:
+            self.__journal.mark(src, "condition", signature)
+            return
+        if conditioned is None and os.path.exists(dst):
+            logging.info("Adopting already conditioned " + filename)
+        else:
+            with self.__cache.lock(key):
+                if self.__cache.lookup(key) is None:
+                    self.__runstage(job, "condition", Conditioner.condition,
+                                    src, self.__cache.prepare(key),
+                                    self.__config.gain)
+                    self.__cache.add(key)
+            self.__cache.materialize(key, dst)
+        self.__normalized.add(filename)
+        self.__db.write('INSERT OR REPLACE INTO Conditioned(Name, Key) ' +
+                        'VALUES(?, ?)', (filename, key))
+        with self.__conditionedlock:
+            self.__conditioned[filename] = key
+        self.__journal.mark(src, "condition", signature)
 
-    @classmethod
-    def __addsongtodb(cls, filename):
+    def __contenthash(self, src):
+        '''__contenthash'''
+        signature = self.__journal.signature(self.__journal.stat(src))
+        stored, digest = self.__journal.get(src, "hash")
+        if stored != signature:
+            digest = Cache.hashfile(src)
+            self.__journal.mark(src, "hash", signature, digest)
+        return digest
+
+    def __addsongtodb(self, job, filename):
         '''__addsongtodb'''
         logging.info("Adding song to DB " + filename)
-        full_path_filename = cls.__inpath("normalized", filename)
-        fingerprint = acoustid.fingerprint_file(full_path_filename)
-        pickled = pickle.dumps(fingerprint)
-        con = sqlite.connect(cls.__dbfile)
-        cursor = con.cursor()
-        try:
-            cursor.execute('INSERT INTO ' +
-                           'Songs("Input File Name", AcoustID) ' +
-                           'VALUES(?, ?)''', (filename, pickled,))
-            con.commit()
-        except Exception:
-            logging.info(filename + " already present")
+        full_path_filename = self.__normalized.path(filename)
+        duration, encoded, algorithm, raw = self.__runstage(
+            job, "fingerprint", Fingerprinter.fingerprint, full_path_filename)
+        index = self.__getfpindex()
+        # Two copies of one song fingerprinted together must see each other
+        with self.__fpindexlock:
+            duplicate = index.match(raw)
+            index.add(filename, raw)
+        self.__catalog.add(filename)
+        future = self.__db.write('INSERT INTO ' +
+                                 'Songs("Input File Name") VALUES(?)',
+                                 (filename,))
+        future.add_done_callback(partial(self.__onsongadded, filename))
+        self.__db.write('INSERT OR REPLACE INTO Fingerprints(Song, ' +
+                        'Duration, Algorithm, Data, Encoded, DuplicateOf) ' +
+                        'VALUES(?, ?, ?, ?, ?, ?)',
+                        (filename, duration, algorithm,
+                         raw.astype("<u4").tobytes(), encoded,
+                         duplicate[0] if duplicate else None))
+        original = self.__catalog.get(duplicate[0]) if duplicate else None
+        if original is not None and original["title"] is not None:
+            logging.info(filename + " duplicates " + duplicate[0] +
+                         " (similarity " + "%.2f" % duplicate[1] + ")")
+            self.__db.write('UPDATE Songs SET ' +
+                            'Title = (SELECT Title FROM Songs ' +
+                            'WHERE "Input File Name" == ?), ' +
+                            'Artists = (SELECT Artists FROM Songs ' +
+                            'WHERE "Input File Name" == ?) ' +
+                            'WHERE "Input File Name" == ? AND Title IS NULL',
+                            (duplicate[0], duplicate[0], filename))
+            self.__catalog.settitle(filename, original["title"],
+                                    original["artists"])
+            return
+        if "tag" in job.stages:
+            self.__resolvetitle(filename, duration, encoded)
 
-    @classmethod
-    def __convert(cls, filename):
-        '''__convert'''
-        logging.info("Converting " + filename)
-        outfile = cls.__inpath("mp3", filename[:-3] + "mp3")
-        if not os.path.exists(outfile):
-            infile = cls.__inpath("pool", filename)
-            cmd = ["ffmpeg", "-i", infile, "-map_metadata", "0:s:0",
-                   "-q:a", "6", outfile]
-            output, err, retcode = cls.__logcommand(cmd)
-            return retcode
-        return 0
+    def __resolvetitle(self, filename, duration, encoded):
+        '''__resolvetitle'''
+        if self.__resolver is None or not encoded:
+            return
+        if isinstance(encoded, bytes):
+            encoded = encoded.decode("ascii")
+        result = self.__resolver.lookup(duration, encoded).result()
+        if result is None:
+            logging.info("No AcoustID match for " + filename)
+            return
+        title, artists = result
+        logging.info("Resolved " + filename + " as " + title + " _ " +
+                     artists)
+        self.__db.write('UPDATE Songs SET Title = ?, Artists = ? ' +
+                        'WHERE "Input File Name" == ? AND Title IS NULL',
+                        (title, artists, filename))
+        self.__catalog.settitle(filename, title, artists)
 
-    @classmethod
-    def __parallelize(cls, action, targets):
-        '''__parallelize'''
-        pool = ThreadPool(cls.threads)
-        pool.map(action, targets)
-        pool.close()
-        pool.join()
+    def __resolvestored(self, filename):
+        '''__resolvestored'''
+        rows = self.__db.query('SELECT Duration, Encoded FROM Fingerprints ' +
+                               'WHERE Song == ?', (filename,))
+        if rows != []:
+            self.__resolvetitle(filename, rows[0][0], rows[0][1])
 
-    @classmethod
-    def __reindex(cls):
-        '''__reindex'''
-        for src in os.listdir("."):
-            if src == 'Archive.txt' or src == '.directory':
-                continue
-            pos = src.find('-')
-            if pos >= 3:
+    def __getfpindex(self):
+        '''__getfpindex'''
+        with self.__fpindexlock:
+            if self.__fpindex is None:
+                index = FingerprintIndex(self.__config.indexstride,
+                                         self.__config.similarity)
+                for song, data in self.__db.query('SELECT Song, Data ' +
+                                                  'FROM Fingerprints'):
+                    index.add(song, np.frombuffer(data, dtype="<u4"))
+                self.__fpindex = index
+            return self.__fpindex
+
+    def __migratefingerprints(self):
+        '''__migratefingerprints'''
+        rows = self.__db.query('SELECT "Input File Name", AcoustID ' +
+                               'FROM Songs WHERE AcoustID IS NOT NULL AND ' +
+                               '"Input File Name" NOT IN ' +
+                               '(SELECT Song FROM Fingerprints)')
+        for filename, pickled in rows:
+            try:
+                duration, encoded = FingerprintUnpickler(
+                    io.BytesIO(pickled)).load()
+                algorithm, raw = Fingerprinter.decode(encoded)
+            except Exception as e:
+                logging.warning("Cannot migrate fingerprint of " +
+                                filename + ": " + str(e))
                 continue
-            if pos is 1:
-                prefix = '00'
-            else:
-                prefix = '0'
-            dst = prefix + src
-            os.rename(src, dst)
+            if isinstance(encoded, bytes):
+                encoded = encoded.decode("ascii")
+            self.__db.write('INSERT INTO Fingerprints(Song, Duration, ' +
+                            'Algorithm, Data, Encoded) ' +
+                            'VALUES(?, ?, ?, ?, ?)',
+                            (filename, duration, algorithm,
+                             raw.astype("<u4").tobytes(), encoded))
+            self.__db.write('UPDATE Songs SET AcoustID = NULL ' +
+                            'WHERE "Input File Name" == ?', (filename,))
+        self.__db.flush()
 
-    @classmethod
-    def __parallelcondition(cls):
-        '''__parallelcondition'''
-        targets = [x for x in os.listdir(".")
-                   if (x.endswith("ogg") and
-                       x not in os.listdir(cls.__paths["normalized"]))]
-        targets.sort()
-        cls.__parallelize(action=cls.__condition, targets=targets)
+    def __onsongadded(self, filename, future):
+        '''__onsongadded'''
+        if isinstance(future.exception(), sqlite.IntegrityError):
+            logging.info(filename + " already present")
+        elif future.exception() is not None:
+            logging.error("Failed adding " + filename + " to DB: " +
+                          str(future.exception()))
 
-    @classmethod
-    def __parallelconvert(cls):
-        '''__parallelconvert'''
-        targets = [x for x in os.listdir(cls.__paths["pool"])
-                   if (x.endswith("ogg"))]
-        targets.sort()
-        cls.__parallelize(action=cls.__convert, targets=targets)
+    def __profilepath(self, profile):
+        '''__profilepath'''
+        if profile == self.__config.library:
+            return self.__config.paths["mp3"]
+        return self.__inpath("encoded", profile[0] + "-" + profile[1])
 
-    @classmethod
-    def __getrawplaylist(cls):
-        playlist = [x for x in os.listdir(".") if x.endswith("ogg")]
-        playlist.sort()
-        cls.__playlist["rawplaylist"] = playlist
+    def __layout(self, profile):
+        '''__layout'''
+        with self.__layoutslock:
+            if profile not in self.__layouts:
+                root = self.__profilepath(profile)
+                tree = os.path.relpath(root, self.__config.paths["basepath"])
+                layout = Layout(tree, root, self.__db, self.__journal)
+                layout.load()
+                self.__layouts[profile] = layout
+            return self.__layouts[profile]
 
-    @classmethod
-    def __loadsongsdb(cls):
-        '''__loadsongsdb'''
-        con = sqlite.connect(cls.__dbfile)
-        cursor = con.cursor()
-        cursor.execute('SELECT "Input File Name", Title, Artists'
-                       ' FROM Songs')
-        cls.songslist = [{"in": x[0], "title": x[1], "artists": x[2]}
-                         for x in cursor.fetchall()]
-
-    @classmethod
-    def __paralleladdsongtodb(cls):
-        '''__paralleladdsongtodb'''
-        cls.__loadsongsdb()
-        filenames = [x["in"] for x in cls.songslist]
-        filenames.sort()
-        targets = [x for x in os.listdir(cls.__paths["normalized"])
-                   if x.endswith("ogg") and x not in filenames]
-        targets.sort()
-        cls.__parallelize(action=cls.__addsongtodb, targets=targets)
-
-    @classmethod
-    def __extractuniquenotnulltitles(cls):
-        '''__extractuniquenotnulltitles'''
-        con = sqlite.connect(cls.__dbfile)
-        cursor = con.cursor()
-        columns = 'Title, Artists, "Input File Name"'
-        cursor.execute('SELECT ' + columns + ' FROM Songs ' +
-                       'WHERE Title is not NULL and Artists is not NULL ' +
-                       'order by ' + columns)
-        raw_targets = [{'title': x[0], 'artists': x[1], 'in': x[2]}
-                       for x in cursor.fetchall()]
-        i = 0
-        j = 0
-        targets = []
-        targets.append(raw_targets[j])
-        for j in range(len(raw_targets)):
-            if (targets[i]["title"] != raw_targets[j]["title"]) or \
-               (targets[i]["artists"] != raw_targets[j]["artists"]):
-                targets.append(raw_targets[j])
-                i += 1
-        return targets
-
-    @classmethod
-    def __assemblename(cls, title, artists, ext):
-        '''__assemblename'''
-        return title + " _ " + artists + "." + ext
+    def __profilename(self, name, profile):
+        '''__profilename'''
+        return name[:-len("mp3")] + profile[0]
 
-    @classmethod
-    def __assembleoggname(cls, title, artists):
-        '''__assembleoggname'''
-        return cls.__assemblename(title=title, artists=artists, ext="ogg")
+    def __lock(self, kind, key):
+        '''__lock'''
+        with self.__lockslock:
+            if (kind, key) not in self.__locks:
+                self.__locks[(kind, key)] = threading.Lock()
+            return self.__locks[(kind, key)]
 
-    @classmethod
-    def __assemblemp3name(cls, title, artists):
-        '''__assemblemp3name'''
-        return cls.__assemblename(title=title, artists=artists, ext="mp3")
-
-    @classmethod
-    def __copyandtag(cls, target):
-        '''__copyandtag'''
-        src = cls.__inpath("normalized", target['in'])
-        out = cls.__assembleoggname(target['title'], target['artists'])
-        dst = cls.__inpath("pool", out)
+    def __encode(self, job, song, profile):
+        '''__encode'''
+        src = self.__normalized.path(song["in"])
+        name = Catalog.assemblename(song["title"], song["artists"],
+                                    profile[0])
+        layout = self.__layout(profile)
+        dst = layout.prepare(name)
         if not os.path.exists(src):
-            return
-        if not os.path.exists(dst):
-            try:
-                copyfile(src, dst)
-            except Exception:
-                logging.info("Failed copying " + src + " to " + dst)
-                return
+            return 1
+        with self.__lock("encode", dst), \
+                job.metrics.measure("convert", "-".join(profile)):
+            returncode = self.__encodefile(job, src, dst, song, profile)
+        if returncode == 0:
+            layout.add(name)
+        return returncode
+
+    def __encodefile(self, job, src, dst, song, profile):
+        '''__encodefile'''
+        signature = self.__journal.signature(self.__journal.stat(src),
+                                             song["title"], song["artists"],
+                                             profile)
+        if self.__journal.done(dst, "convert", signature):
+            return 0
+        previous, data = self.__journal.get(dst, "convert")
+        if previous is None and os.path.exists(dst):
+            self.__journal.mark(dst, "convert", signature)
+            return 0
+        logging.info("Converting " + os.path.basename(dst))
+        returncode = self.__encoder.encode(
+            src, dst, Encoder.options(*profile),
+            {"title": song["title"], "artist": song["artists"]},
+            job.metrics).result()
+        if returncode == 0:
+            self.__journal.mark(dst, "convert", signature)
+        return returncode
+
+    def __parallelize(self, action, targets):
+        '''__parallelize'''
+        with ThreadPoolExecutor(self.__config.threads) as executor:
+            list(executor.map(action, targets))
+
+    def __measured(self, job, stage, action, target):
+        '''__measured'''
         try:
-            ogg = OggVorbis(dst)
-            if ogg.get("title", None) is None or \
-               ogg.get("artist", None) is None or \
-               ogg["title"] != target["title"] or \
-               ogg["artist"] != target["artists"]:
-                ogg["title"] = target["title"]
-                ogg["artist"] = target["artists"]
-                ogg.save(dst)
+            with job.metrics.measure(stage, target["name"]):
+                action(job, target)
         except Exception:
-            logging.info("Failed tagging " + dst)
+            logging.exception(stage + " of " + target["name"] + " failed")
+            job.metrics.record("failed", target["name"], {})
 
-    @classmethod
-    def __parallelcopyandtag(cls):
-        '''__parallelcopyandtag'''
-        targets = cls.__extractuniquenotnulltitles()
-        cls.__parallelize(action=cls.__copyandtag, targets=targets)
+    def __newexecutor(self, stage):
+        '''__newexecutor'''
+        if stage in self.__config.processstages:
+            return concurrent.futures.ProcessPoolExecutor(
+                self.__config.workers[stage],
+                mp_context=multiprocessing.get_context("forkserver"),
+                initializer=Syphon.initlogger,
+                initargs=(self.__config.logpath, logging.DEBUG,
+                          logging.DEBUG, logging.WARNING))
+        return ThreadPoolExecutor(self.__config.workers[stage],
+                                  thread_name_prefix=stage)
 
-    @classmethod
-    def __refinerawplaylist(cls, rawplaylist):
+    def __startexecutors(self):
+        '''__startexecutors'''
+        self.__executors = {}
+        for stage in ("condition", "fingerprint"):
+            self.__executors[stage] = self.__newexecutor(stage)
+
+    def __restartexecutor(self, stage, broken):
+        '''__restartexecutor'''
+        with self.__lock("executor", stage):
+            if self.__executors[stage] is broken:
+                logging.error("The " + stage + " workers died, restarting")
+                self.__executors[stage] = self.__newexecutor(stage)
+        broken.shutdown(wait=False)
+
+    def __stopexecutors(self):
+        '''__stopexecutors'''
+        for executor in self.__executors.values():
+            executor.shutdown()
+        self.__executors = {}
+
+    def __runstage(self, job, stage, action, *args):
+        '''__runstage'''
+        executor = self.__executors[stage]
+        try:
+            result, sample = executor.submit(
+                Metrics.timed, time.time(), action, *args).result()
+        except BrokenExecutor:
+            self.__restartexecutor(stage, executor)
+            raise
+        job.metrics.record(stage, "", sample)
+        return result
+
+    def __loadsongsdb(self):
+        '''__loadsongsdb'''
+        rows = self.__db.query('SELECT "Input File Name", Title, Artists'
+                               ' FROM Songs')
+        self.__catalog = Catalog([{"in": x[0], "title": x[1], "artists": x[2]}
+                                 for x in rows])
+
+    def __assemblemp3name(self, title, artists):
+        '''__assemblemp3name'''
+        return Catalog.assemblename(title=title, artists=artists, ext="mp3")
+
+    def __refinerawplaylist(self, rawplaylist):
         '''__refinerawplaylist'''
         playlist = []
         for filename in rawplaylist:
-            entry = [x for x in cls.songslist
-                     if (x["in"] == filename and x["title"] is not None and
-                         x["artists"] is not None)]
-            if len(entry) > 0:
-                out = cls.__assemblemp3name(entry[0]["title"],
-                                            entry[0]["artists"])
+            out = self.__catalog.mp3name(self.__trackname(filename))
+            if out is not None:
                 playlist.append(out)
         return playlist
 
-    @classmethod
-    def __storeplaylisttofile(cls, target):
+    def __storeplaylisttofile(self, target):
         '''__storeplaylisttofile'''
-        plsfile = cls.__inpath("pls", target["name"] + ".m3u")
+        plsfile = self.__inpath("pls", target["name"] + ".m3u")
+        content = "".join(["mp3/" + x + "\n" for x in target["playlist"]])
+        if os.path.exists(plsfile):
+            with open(plsfile) as src:
+                if src.read() == content:
+                    return
         with open(plsfile, "w") as dst:
-            dst.writelines(["mp3/" + x + "\n"
-                            for x in target["playlist"]])
+            dst.write(content)
 
-    @classmethod
-    def __storeplaylisttodb(cls, name, plstype, playlist):
+    def __storeplaylisttodb(self, name, plstype, playlist):
         '''__storeplaylisttodb'''
-        logging.info("Adding playlist to DB " + name)
-        playlist = str(playlist)
         try:
-            con = sqlite.connect(cls.__dbfile)
-            cursor = con.cursor()
-            cursor.execute('SELECT Songs from Playlists ' +
-                           'WHERE Playlist == ?', (name,))
-            oldplaylist = cursor.fetchall()
-            if oldplaylist != [] and oldplaylist[0][0] == playlist:
+            rows = self.__db.query('SELECT Type FROM Playlists ' +
+                                   'WHERE Playlist == ?', (name,))
+            if rows != [(plstype,)]:
+                self.__db.write('INSERT OR REPLACE INTO ' +
+                                'Playlists(Playlist, Type) VALUES(?, ?)',
+                                (name, plstype))
+            old = [x[0] for x in self.__db.query(
+                'SELECT Song FROM PlaylistEntries WHERE Playlist == ? ' +
+                'ORDER BY Position', (name,))]
+            changed = [i for i in range(min(len(old), len(playlist)))
+                       if old[i] != playlist[i]]
+            if not changed and len(old) == len(playlist):
                 return
-            con = sqlite.connect(cls.__dbfile)
-            cursor = con.cursor()
-            if oldplaylist == []:
-                cursor.execute('INSERT INTO ' +
-                               'Playlists(Playlist, Type, Songs) ' +
-                               'VALUES(?, ?, ?)',
-                               (name, plstype, playlist,))
-            else:
-                cursor.execute('UPDATE Playlists ' +
-                               'SET Songs = ?, Type = ? ' +
-                               'WHERE Playlist == ?',
-                               (playlist, plstype, name))
-            con.commit()
+            logging.info("Updating playlist " + name + " in DB")
+            for i in changed:
+                self.__db.write('UPDATE PlaylistEntries SET Song = ? ' +
+                                'WHERE Playlist == ? AND Position == ?',
+                                (playlist[i], name, i))
+            for i in range(len(old), len(playlist)):
+                self.__db.write('INSERT INTO PlaylistEntries(Playlist, ' +
+                                'Position, Song) VALUES(?, ?, ?)',
+                                (name, i, playlist[i]))
+            self.__db.write('DELETE FROM PlaylistEntries ' +
+                            'WHERE Playlist == ? AND Position >= ?',
+                            (name, len(playlist))).result()
         except Exception:
             logging.info("error storing playlist " + name)
             return
 
-    @classmethod
-    def __updateautoplaylist(cls, target):
+    def __updateautoplaylist(self, job, target):
         '''__updateautoplaylist'''
+        if "rawplaylist" not in target:
+            logging.warning("No listing of " + target["name"] +
+                            ", keeping the stored playlist")
+            return
         rawplaylist = target["rawplaylist"]
-        target["playlist"] = cls.__refinerawplaylist(rawplaylist)
-        cls.__storeplaylisttofile(target)
-        cls.__storeplaylisttodb(target["name"], target["type"],
-                                target["playlist"])
+        target["playlist"] = self.__refinerawplaylist(rawplaylist)
+        self.__storeplaylisttofile(target)
+        self.__storeplaylisttodb(target["name"], target["type"],
+                                 target["playlist"])
 
-    @classmethod
-    def __parallelupdateautoplaylist(cls):
+    def __parallelupdateautoplaylist(self, job):
         '''__parallelupdateautoplaylist'''
-        cls.__loadsongsdb()
-        targets = [x for x in cls.__playlists if x["type"] == "auto"]
-        cls.__parallelize(action=cls.__updateautoplaylist, targets=targets)
+        targets = [x for x in job.playlists if x["type"] == "auto"]
+        self.__parallelize(action=partial(self.__measured, job,
+                                          "updateautoplaylist",
+                                          self.__updateautoplaylist),
+                           targets=targets)
 
-    @classmethod
-    def __loadcustomplaylists(cls):
+    def __loadcustomplaylists(self, job):
         '''__loadcustomplaylist'''
-        filenames = [x for x in os.listdir(cls.__paths["custom"])
-                     if x.endswith(".m3u")]
+        filenames = [x for x in os.listdir(self.__config.paths["custom"])
+                     if x.endswith(".m3u") and
+                     (job.names is None or x[:-4] in job.names)]
         for filename in filenames:
-            with open(cls.__inpath("custom", filename)) as infile:
+            with open(self.__inpath("custom", filename)) as infile:
                 lines = [l.split('/')[-1][:-4] + "mp3"
                          for l in infile.readlines()
                          if not l.startswith("#")]
-            cls.__playlists.append({
+            for line in lines:
+                if self.__catalog.bymp3(line) is None:
+                    logging.warning(filename + ": no song for " + line)
+            job.playlists.append({
                 "name": filename[:-4],
                 "type": "custom",
                 "playlist": [str(l) for l in lines]
                 })
 
-    @classmethod
-    def __updatecustomplaylist(cls, target):
+    def __updatecustomplaylist(self, job, target):
         '''__updatecustomplaylist'''
-        cls.__storeplaylisttofile(target)
-        cls.__storeplaylisttodb(target["name"], target["type"],
-                                target["playlist"])
+        self.__storeplaylisttofile(target)
+        self.__storeplaylisttodb(target["name"], target["type"],
+                                 target["playlist"])
 
-    @classmethod
-    def __parallelupdatecustomplaylist(cls):
+    def __parallelupdatecustomplaylist(self, job):
         '''__parallelupdatecustomplaylist'''
-        cls.__loadcustomplaylists()
-        targets = [x for x in cls.__playlists if x["type"] == "custom"]
-        cls.__parallelize(action=cls.__updatecustomplaylist, targets=targets)
+        self.__loadcustomplaylists(job)
+        targets = [x for x in job.playlists if x["type"] == "custom"]
+        self.__parallelize(action=partial(self.__measured, job,
+                                          "updatecustomplaylist",
+                                          self.__updatecustomplaylist),
+                           targets=targets)
 
-    @classmethod
-    def __preparepath(cls, path):
+    def __preparepath(self, path):
         '''__preparepath'''
         try:
             if not os.path.exists(path):
                 os.mkdir(path)
-        except Exception:
-            print("Error while preparing " + path)
-            exit(-1)
+        except OSError:
+            logging.error("Error while preparing " + path)
+            raise
 
-    @classmethod
-    def __preparebasepaths(cls):
+    def __preparebasepaths(self):
         '''__preparebasepath'''
-        paths = [cls.__paths["basepath"], cls.__paths["downloads"],
-                 cls.__paths["normalized"], cls.__paths["pool"],
-                 cls.__paths["mp3"], cls.__paths["pls"],
-                 cls.__paths["custom"], cls.__paths["devices"], ]
+        paths = [self.__config.paths[x]
+                 for x in ("basepath", "downloads", "store", "incoming",
+                           "normalized", "encoded", "mp3", "pls", "custom",
+                           "devices", "cache")]
         for path in paths:
-            cls.__preparepath(path)
+            self.__preparepath(path)
 
-    @classmethod
-    def __updateytplaylist(cls):
-        '''__updateytplaylist'''
-        cls.__preparepath(cls.__playlist["path"])
-        os.chdir(cls.__playlist["path"])
-        cls.__downloadnewsongs()
-        cls.__reindex()
-        cls.__parallelcondition()
-        cls.__getrawplaylist()
+    def __cleanvideos(self, playlist):
+        '''__cleanvideos'''
+        entries = os.listdir(playlist["path"])
+        audio = set(os.path.splitext(x)[0] for x in entries
+                    if x.endswith(AUDIO_EXTENSIONS))
+        videos = [x for x in entries if x.endswith(VIDEO_EXTENSIONS) and
+                  os.path.splitext(x)[0] in audio]
+        freed = 0
+        for video in videos:
+            path = os.path.join(playlist["path"], video)
+            freed += os.path.getsize(path)
+            os.remove(path)
+        if videos:
+            logging.info(playlist["name"] + ": removed " + str(len(videos)) +
+                         " videos, " + str(freed // (1024 * 1024)) + " MB")
 
-    @classmethod
-    def __createpath(cls, path):
+    def __titlekey(self, title):
+        '''__titlekey'''
+        return "".join(x for x in title.lower() if x.isalnum())
+
+    def __adoptlegacy(self, playlist):
+        '''__adoptlegacy'''
+        archive = os.path.join(playlist["path"], "Archive.txt")
+        if not os.path.exists(archive):
+            return
+        if self.__config.download["cleanvideos"]:
+            self.__cleanvideos(playlist)
+        with open(archive) as infile:
+            archived = set(x.strip() for x in infile)
+        files = {}
+        for filename in os.listdir(playlist["path"]):
+            stem, ext = os.path.splitext(filename)
+            if ext in AUDIO_EXTENSIONS:
+                files[self.__titlekey(stem.split("-", 1)[-1])] = filename
+        for video in playlist["listing"]:
+            if video["key"] not in archived or \
+               video["key"] in self.__downloads:
+                continue
+            filename = files.get(self.__titlekey(video["title"]))
+            if filename is not None:
+                self.__archive(video["key"],
+                               os.path.join(playlist["path"], filename),
+                               video["title"])
+
+    def __storeorder(self, playlist):
+        '''__storeorder'''
+        self.__db.write('DELETE FROM PlaylistVideos WHERE Playlist == ?',
+                        (playlist["name"],))
+        for position, video in enumerate(playlist["videos"]):
+            self.__db.write('INSERT INTO PlaylistVideos(Playlist, ' +
+                            'Position, Video) VALUES(?, ?, ?)',
+                            (playlist["name"], position, video))
+
+    def __finishlisting(self, job, playlist, listing):
+        '''__finishlisting'''
+        result = listing.result()
+        if result.returncode == 0 or playlist["listing"]:
+            self.__adoptlegacy(playlist)
+            playlist["videos"] = [x["key"] for x in playlist["listing"]]
+            self.__storeorder(playlist)
+            return
+        logging.warning("Listing of " + playlist["name"] + " failed, " +
+                        "using the stored order")
+        self.__loadorder(playlist)
+
+    def __loadorder(self, playlist):
+        '''__loadorder'''
+        rows = self.__db.query('SELECT Video FROM PlaylistVideos ' +
+                               'WHERE Playlist == ? ORDER BY Position',
+                               (playlist["name"],))
+        if rows:
+            playlist["videos"] = [x[0] for x in rows]
+
+    def __fetchvideos(self, job, playlist):
+        '''__fetchvideos'''
+        waiting = set()
+        chunks = []
+        with self.__downloadslock:
+            for video in playlist["listing"]:
+                if video["key"] in self.__downloads:
+                    continue
+                if video["key"] in self.__inflight:
+                    if self.__inflight[video["key"]] is not None:
+                        waiting.add(self.__inflight[video["key"]])
+                    continue
+                if not chunks or \
+                   len(chunks[-1]) == self.__config.download["batch"]:
+                    chunks.append({})
+                chunks[-1][video["id"]] = video
+                self.__inflight[video["key"]] = None
+            downloads = [self.__downloadnewsongs(job, x) for x in chunks]
+            for chunk, download in zip(chunks, downloads):
+                for video in chunk.values():
+                    self.__inflight[video["key"]] = download
+        for chunk, download in zip(chunks, downloads):
+            download.add_done_callback(partial(self.__fetched, chunk))
+            waiting.add(download)
+        if chunks:
+            logging.info(playlist["name"] + ": downloading " +
+                         str(sum(len(x) for x in chunks)) + " new videos")
+        return [(x, playlist) for x in waiting]
+
+    def __fetched(self, chunk, download):
+        '''__fetched'''
+        with self.__downloadslock:
+            for video in chunk.values():
+                self.__inflight.pop(video["key"], None)
+
+    def __finishdownload(self, job, playlist, download):
+        '''__finishdownload'''
+        result = download.result()
+        job.metrics.record("download", playlist["name"],
+                           dict(result.usage, wall=result.elapsed,
+                                wait=result.waited))
+        if result.returncode:
+            logging.warning("Download for " + playlist["name"] +
+                            " ended with errors, progress " +
+                            str(result.progress))
+
+    def __submitplaylist(self, job, playlist):
+        '''__submitplaylist'''
+        if "videos" not in playlist:
+            return
+        with self.__downloadslock:
+            playlist["rawplaylist"] = [self.__downloads[x]
+                                       for x in playlist["videos"]
+                                       if x in self.__downloads]
+        if any(x in job.stages for x in TRACK_STAGES):
+            self.__submittracks(job, playlist["rawplaylist"])
+
+    def __createpath(self, path):
         '''__createpath'''
         if os.path.exists(path) and os.path.isfile(path):
             os.remove(path)
-        if not os.path.exists(path):
-            os.mkdir(path)
+        # Device IO workers create the same shard folders concurrently
+        os.makedirs(path, exist_ok=True)
 
-    @classmethod
-    def __updatedevice(cls, device):
+    def __removeentry(self, path):
+        '''__removeentry'''
+        if os.path.isfile(path) or os.path.islink(path):
+            os.remove(path)
+        else:
+            rmtree(path)
+
+    def __syncfile(self, content, dst):
+        '''__syncfile'''
+        if os.path.exists(dst):
+            with open(dst, "rb") as outfile:
+                if outfile.read() == content:
+                    return
+        with open(dst + ".part", "wb") as outfile:
+            outfile.write(content)
+        os.replace(dst + ".part", dst)
+
+    def __copytodevice(self, job, device, layout, entries, link, entry):
+        '''__copytodevice'''
+        src = layout.path(entries[entry])
+        dst = os.path.join(self.__inpath("devices", device["name"]), "mp3",
+                           entry)
+        self.__createpath(os.path.dirname(dst))
+        with job.metrics.measure("copytodevice", device["name"]):
+            stat = self.__journal.stat(src)
+            digest = self.__contenthash(src)
+            Materializer.materialize(src, dst, link)
+        self.__db.write('INSERT OR REPLACE INTO DeviceFiles(Device, Name, ' +
+                        'Size, MTime, Hash) VALUES(?, ?, ?, ?, ?)',
+                        (device["name"], entry, stat[0], stat[1], digest))
+
+    def __diffdevice(self, device, layout, entries, curmp3):
+        '''__diffdevice'''
+        manifest = {x[0]: x[1:] for x in self.__db.query(
+            'SELECT Name, Size, MTime, Hash FROM DeviceFiles ' +
+            'WHERE Device == ?', (device["name"],))}
+        for entry in set(manifest) - curmp3:
+            self.__db.write('DELETE FROM DeviceFiles ' +
+                            'WHERE Device == ? AND Name == ?',
+                            (device["name"], entry))
+        tocopy = []
+        for entry in sorted(entries):
+            src = layout.path(entries[entry])
+            if entries[entry] not in layout:
+                logging.warning(device["name"] + ": missing " + entry)
+                continue
+            stat = self.__journal.stat(src)
+            if entry in curmp3 and entry in manifest:
+                size, mtime, digest = manifest[entry]
+                if [size, mtime] == stat:
+                    continue
+                if self.__contenthash(src) == digest:
+                    self.__db.write('UPDATE DeviceFiles SET ' +
+                                    'Size = ?, MTime = ? ' +
+                                    'WHERE Device == ? AND Name == ?',
+                                    (stat[0], stat[1], device["name"], entry))
+                    continue
+            elif entry in curmp3:
+                dst = os.path.join(self.__inpath("devices", device["name"]),
+                                   "mp3", entry)
+                if os.path.getsize(dst) == stat[0]:
+                    self.__db.write('INSERT OR REPLACE INTO ' +
+                                    'DeviceFiles(Device, Name, Size, ' +
+                                    'MTime, Hash) VALUES(?, ?, ?, ?, ?)',
+                                    (device["name"], entry, stat[0], stat[1],
+                                     self.__contenthash(src)))
+                    continue
+            tocopy.append(entry)
+        return tocopy
+
+    def __encodedevice(self, job, device, mp3list):
+        '''__encodedevice'''
+        songs = [self.__catalog.bymp3(x) for x in sorted(mp3list)]
+        songs = [x for x in songs if x is not None]
+        logging.info(device["name"] + ": encoding " + str(len(songs)) +
+                     " files as " + "-".join(device["profile"]))
+        with ThreadPoolExecutor(self.__config.workers["convert"] *
+                                self.__config.encodebatch) as pool:
+            list(pool.map(partial(self.__encode, job,
+                                  profile=device["profile"]), songs))
+
+    def __deviceentry(self, device, name):
+        '''__deviceentry'''
+        if device["sharded"]:
+            return Layout.shard(name) + "/" + name
+        return name
+
+    def __listdevice(self, mp3path):
+        '''__listdevice'''
+        entries = set()
+        for entry in os.scandir(mp3path):
+            if entry.is_dir():
+                entries.update(entry.name + "/" + x
+                               for x in os.listdir(entry.path))
+            else:
+                entries.add(entry.name)
+        return entries
+
+    def __updatedevice(self, job, device):
         '''__updatedevice'''
-        devicepath = cls.__inpath("devices", device["name"])
-        cls.__createpath(devicepath)
+        devicepath = self.__inpath("devices", device["name"])
+        self.__createpath(devicepath)
         mp3path = os.path.join(devicepath, "mp3")
-        cls.__createpath(mp3path)
-        for entry in os.listdir(devicepath):
-            fullentry = os.path.join(devicepath, entry)
-            if os.path.isfile(fullentry):
-                os.remove(fullentry)
-            else:
-                if entry != "mp3":
-                    rmtree(fullentry)
-        mp3list = []
+        self.__createpath(mp3path)
+        profile = device["profile"]
+        mp3list = set()
+        wanted = set(["mp3"])
         for p in device["playlists"]:
-            srcpl = cls.__inpath("pls", p + ".m3u")
+            srcpl = self.__inpath("pls", p + ".m3u")
             if os.path.exists(srcpl):
+                with open(srcpl) as infile:
+                    names = [line[len("mp3/"):]
+                             for line in infile.read().splitlines()]
+                content = "".join([
+                    "mp3/" + self.__deviceentry(device, self.__profilename(
+                        x, profile)) + "\n" for x in names])
                 dstpl = os.path.join(devicepath, p + ".m3u")
-                copyfile(srcpl, dstpl)
-                mp3list.extend([pl for pl in cls.__playlists
-                                if pl["name"] == p][0]["playlist"])
-        curmp3 = os.listdir(mp3path)
-        for entry in curmp3:
-            if entry not in mp3list:
-                fullentry = os.path.join(mp3path, entry)
-                if os.path.isfile(fullentry):
-                    os.remove(fullentry)
-                else:
-                    rmtree(fullentry)
-        for entry in mp3list:
-            if entry not in curmp3:
-                srcmp3 = cls.__inpath("mp3", entry)
-                dstmp3 = os.path.join(mp3path, entry)
-                copy2(srcmp3, dstmp3)
+                self.__syncfile(content.encode("utf-8"), dstpl)
+                wanted.add(p + ".m3u")
+                mp3list.update(names)
+        if profile != self.__config.library:
+            self.__encodedevice(job, device, mp3list)
+        layout = self.__layout(profile)
+        entries = {}
+        for name in (self.__profilename(x, profile) for x in mp3list):
+            entries[self.__deviceentry(device, name)] = name
+        for entry in os.listdir(devicepath):
+            if entry not in wanted:
+                self.__removeentry(os.path.join(devicepath, entry))
+        curmp3 = self.__listdevice(mp3path)
+        for entry in curmp3 - set(entries):
+            self.__removeentry(os.path.join(mp3path, entry))
+        for entry in os.scandir(mp3path):
+            if entry.is_dir() and not os.listdir(entry.path):
+                os.rmdir(entry.path)
+        curmp3 &= set(entries)
+        tocopy = self.__diffdevice(device, layout, entries, curmp3)
+        logging.info(device["name"] + ": " + str(len(tocopy)) +
+                     " files to copy, " + str(len(entries) - len(tocopy)) +
+                     " up to date")
+        link = os.stat(layout.root).st_dev == os.stat(mp3path).st_dev
+        with ThreadPoolExecutor(device["ioworkers"],
+                                thread_name_prefix=device["name"]) as pool:
+            list(pool.map(partial(self.__copytodevice, job, device, layout,
+                                  entries, link), tocopy))
 
-    @classmethod
-    def __parallelupdatedevices(cls):
+    def __parallelupdatedevices(self, job):
         '''__parallelupdatedevices'''
-        for entry in os.listdir(cls.__paths["devices"]):
-            fullentry = cls.__inpath("devices", entry)
-            if entry not in [d["name"] for d in cls.__devices]:
-                if os.path.isfile(fullentry):
-                    os.remove(fullentry)
-                else:
-                    rmtree(fullentry)
-        cls.__parallelize(action=cls.__updatedevice, targets=cls.__devices)
+        names = set(d["name"] for d in self.__config.devices)
+        for entry in os.listdir(self.__config.paths["devices"]):
+            fullentry = self.__inpath("devices", entry)
+            if entry not in names:
+                self.__removeentry(fullentry)
+                self.__db.write('DELETE FROM DeviceFiles WHERE Device == ?',
+                                (entry,))
+        self.__parallelize(action=partial(self.__measured, job,
+                                          "updatedevice",
+                                          self.__updatedevice),
+                           targets=job.devices)
+        self.__db.flush()
 
-    @classmethod
-    def run(cls):
+    def __processtrack(self, job, src):
+        '''__processtrack'''
+        filename = self.__trackname(src)
+        signature = self.__tracksignature(src, filename)
+        if self.__journal.done(src, "track", signature):
+            return
+        if "condition" in job.stages and \
+           not src.startswith(self.__normalized.root + os.sep):
+            self.__condition(job, src)
+        if filename not in self.__normalized:
+            return
+        with job.metrics.measure("addsongtodb"):
+            if filename not in self.__catalog:
+                if "index" not in job.stages:
+                    return
+                self.__addsongtodb(job, filename)
+            elif "tag" in job.stages and \
+                    self.__catalog.get(filename)["title"] is None:
+                self.__resolvestored(filename)
+        target = self.__catalog.canonical(filename)
+        if "convert" in job.stages and target is not None:
+            returncode = self.__encode(job, target, self.__config.library)
+            if returncode != 0:
+                raise StageError("Converting " + target["in"] +
+                                 " ended with " + str(returncode))
+        if all(x in job.stages for x in TRACK_STAGES) and \
+           self.__catalog.get(filename)["title"] is not None:
+            self.__journal.mark(src, "track",
+                                self.__tracksignature(src, filename))
+
+    def __runtrack(self, job, src, submitted):
+        '''__runtrack'''
+        if src.startswith(self.__normalized.root + os.sep):
+            label = self.__normalized.tree
+        else:
+            label = os.path.basename(os.path.dirname(src))
+        filename = self.__trackname(src)
+        with job.metrics.measure("track", label, submitted), \
+                self.__lock("track", filename):
+            signature = self.__sourcesignature(src)
+            if self.__tracker.quarantined(src, signature):
+                logging.info("Skipping quarantined " + filename)
+                job.metrics.record("skipped", filename, {})
+                return
+            error = self.__attempttrack(job, src)
+            if error is None:
+                self.__tracker.succeeded(src, signature)
+                return
+            status = self.__tracker.failed(src, signature, error)
+            logging.error(filename + " " + status + ": " + str(error))
+            job.metrics.record(status, filename, {})
+
+    def __attempttrack(self, job, src):
+        '''__attempttrack'''
+        filename = os.path.basename(src)
+        retry = self.__config.retry
+        for attempt in range(retry["attempts"]):
+            if attempt > 0:
+                time.sleep(retry["backoff"] * 2 ** (attempt - 1))
+                job.metrics.record("retry", filename, {})
+            try:
+                self.__processtrack(job, src)
+                return None
+            except Exception as e:
+                error = e
+                logging.warning("Attempt " + str(attempt + 1) + " at " +
+                                filename + " failed: " + str(e))
+                if Tracker.permanent(e):
+                    break
+        return error
+
+    def __sourcesignature(self, src):
+        '''__sourcesignature'''
+        try:
+            return self.__journal.signature(self.__journal.stat(src))
+        except OSError:
+            return None
+
+    def __tracksignature(self, src, filename):
+        '''__tracksignature'''
+        song = self.__catalog.get(filename) or {}
+        return self.__journal.signature(self.__journal.stat(src),
+                                        self.__conditionparams(),
+                                        song.get("title", None),
+                                        song.get("artists", None),
+                                        self.__config.library)
+
+    def __loadtracks(self):
+        '''__loadtracks'''
+        self.__loadsongsdb()
+        self.__conditioned = dict(self.__db.query('SELECT Name, Key ' +
+                                                  'FROM Conditioned'))
+        self.__conditionedlock = threading.Lock()
+        self.__fpindex = None
+        self.__fpindexlock = threading.Lock()
+
+    def __submittracks(self, job, sources):
+        '''__submittracks'''
+        with job.submitlock:
+            for src in sources:
+                filename = self.__trackname(src)
+                if filename in job.submitted:
+                    continue
+                job.submitted.add(filename)
+                job.trackfutures.append(
+                    self.__trackexecutor.submit(self.__runtrack, job, src,
+                                                time.time()))
+
+    def __pipelinetracks(self, job):
+        '''__pipelinetracks'''
+        listings = {}
+        if "download" in job.stages:
+            listings = {self.__listplaylist(job, playlist): playlist
+                        for playlist in job.playlists}
+        else:
+            for playlist in job.playlists:
+                self.__loadorder(playlist)
+        downloads = []
+        for listing in as_completed(listings):
+            playlist = listings[listing]
+            try:
+                self.__finishlisting(job, playlist, listing)
+                downloads += self.__fetchvideos(job, playlist)
+            except Exception:
+                logging.exception("Listing of " + playlist["name"] +
+                                  " failed")
+                job.metrics.record("failed", playlist["name"], {})
+        for download, playlist in downloads:
+            try:
+                self.__finishdownload(job, playlist, download)
+            except Exception:
+                logging.exception("Download for " + playlist["name"] +
+                                  " failed")
+                job.metrics.record("failed", playlist["name"], {})
+        for playlist in job.playlists:
+            self.__submitplaylist(job, playlist)
+        if job.sweep:
+            self.__submittracks(job, [self.__normalized.path(x)
+                                      for x in self.__normalized.names()
+                                      if x.endswith("ogg")])
+        for future in list(job.trackfutures):
+            future.result()
+        self.__db.flush()
+
+    def start(self):
+        '''start'''
+        self.__preparebasepaths()
+        self.__scheduler = Scheduler(self.__config.maxcommands,
+                                     self.__config.maxdownloads,
+                                     self.__config.maxperhost,
+                                     self.__config.maxlines)
+        self.__scheduler.start()
+        Schema.migrate(self.__config.dbfile)
+        self.__db = Database(self.__config.dbfile, self.__config.batchrows,
+                             self.__config.batchtime, self.__config.dbreaders)
+        self.__db.start()
+        self.__migratefingerprints()
+        self.__journal = Journal(self.__db)
+        self.__tracker = Tracker(self.__db, self.__config.retry["quarantine"])
+        self.__normalized = Layout("normalized",
+                                   self.__config.paths["normalized"],
+                                   self.__db, self.__journal)
+        self.__normalized.load()
+        self.__store = Layout("store", self.__config.paths["store"],
+                              self.__db, self.__journal)
+        self.__store.load()
+        self.__loaddownloads()
+        self.__layouts = {}
+        self.__layoutslock = threading.Lock()
+        self.__cache = Cache(self.__config.paths["cache"],
+                             self.__config.cachesize, self.__db)
+        self.__encoder = Encoder(self.__config.workers["convert"],
+                                 self.__config.encodebatch,
+                                 self.__config.encodetime,
+                                 self.__scheduler.run)
+        self.__encoder.start()
+        self.__resolver = None
+        acoustidcfg = self.__config.acoustid
+        if acoustidcfg["enabled"]:
+            self.__resolver = Resolver(acoustidcfg["url"], self.__config.key,
+                                       acoustidcfg["batch"],
+                                       acoustidcfg["rate"],
+                                       acoustidcfg["ttl"],
+                                       acoustidcfg["minscore"], self.__db)
+            self.__resolver.start()
+        self.__loadtracks()
+        self.__startexecutors()
+        self.__trackexecutor = ThreadPoolExecutor(
+            sum(self.__config.workers.values()), thread_name_prefix="track")
+
+    def stop(self):
+        '''stop'''
+        self.__trackexecutor.shutdown()
+        self.__stopexecutors()
+        if self.__resolver is not None:
+            self.__resolver.stop()
+        self.__encoder.stop()
+        self.__db.stop()
+        self.__scheduler.stop()
+
+    def __checknames(self, playlists, devices):
+        '''__checknames'''
+        known = set(x["name"] for x in self.__config.playlists)
+        known.update(x[:-4] for x in os.listdir(self.__config.paths["custom"])
+                     if x.endswith(".m3u"))
+        for name in sorted(set(playlists or []) - known):
+            logging.warning("Unknown playlist " + name)
+        known = set(x["name"] for x in self.__config.devices)
+        for name in sorted(set(devices or []) - known):
+            logging.warning("Unknown device " + name)
+
+    def sync(self, playlists=None, devices=None, stages=PIPELINE_STAGES):
+        '''sync'''
+        if devices is not None:
+            devices = [x.lower() for x in devices]
+        self.__checknames(playlists, devices)
+        job = Job([dict(x) for x in self.__config.playlists
+                   if playlists is None or x["name"] in playlists],
+                  [x for x in self.__config.devices
+                   if devices is None or x["name"] in devices],
+                  playlists is None and
+                  any(x in stages for x in TRACK_STAGES),
+                  stages, playlists)
+        logging.info("Running " + ", ".join(stages))
+        self.__pipelinetracks(job)
+        if "playlists" in stages:
+            self.__parallelupdateautoplaylist(job)
+            self.__parallelupdatecustomplaylist(job)
+        if "devices" in stages:
+            self.__parallelupdatedevices(job)
+        self.__cache.evict()
+        with self.__lock("report", self.__config.reportpath):
+            report = job.metrics.write(self.__config.reportpath,
+                                       self.__config.prometheuspath)
+        logging.info("Run completed in " + "%.1f" % report["wall"] + "s")
+        for status in ("failed", "quarantined", "skipped"):
+            if status in report["stages"]:
+                logging.warning(str(report["stages"][status]["count"]) +
+                                " " + status + ": " +
+                                " ".join(report["stages"][status]["labels"]))
+        return report
+
+    def reload(self):
+        '''reload'''
+        config = Config(self.__config.cfgpath)
+        if not config.load():
+            logging.error("Reload failed, keeping the current configuration")
+            return False
+        self.__config.playlists = config.playlists
+        self.__config.devices = config.devices
+        logging.info("Reloaded " + str(len(config.playlists)) +
+                     " playlists and " + str(len(config.devices)) +
+                     " devices")
+        return True
+
+    def __customsignature(self):
+        '''__customsignature'''
+        return sorted((x.name, x.stat().st_mtime_ns, x.stat().st_size)
+                      for x in os.scandir(self.__config.paths["custom"]))
+
+    def __trigger(self, triggers, command, args=[]):
+        '''__trigger'''
+        future = Future()
+        triggers.put((command, args, future))
+        try:
+            return future.result()
+        except CancelledError:
+            return None
+
+    def __tick(self, triggers, stopping):
+        '''__tick'''
+        while not stopping.wait(self.__config.daemon["interval"]):
+            self.__trigger(triggers, "sync")
+
+    def __watch(self, triggers, stopping):
+        '''__watch'''
+        previous = self.__customsignature()
+        while not stopping.wait(DAEMON_POLL):
+            current = self.__customsignature()
+            if current != previous:
+                previous = current
+                logging.info("Custom playlists changed")
+                self.__trigger(triggers, "custom")
+
+    def __listen(self, triggers):
+        '''__listen'''
+        path = self.__config.daemon["socket"]
+        if os.path.exists(path):
+            os.remove(path)
+        server = ThreadingUnixStreamServer(path, ControlHandler)
+        server.daemon_threads = True
+        server.trigger = partial(self.__trigger, triggers)
+        thread = threading.Thread(target=server.serve_forever,
+                                  name="control", daemon=True)
+        thread.start()
+        return server
+
+    def __dispatch(self, command, args):
+        '''__dispatch'''
+        if command == "sync":
+            return self.sync(playlists=args or None)
+        if command == "custom":
+            return self.sync(stages=("playlists", "devices"))
+        if command == "devices":
+            return self.sync(devices=args or None, stages=("devices",))
+        return {"reloaded": self.reload()}
+
+    def serve(self):
+        '''serve'''
+        triggers = queue.Queue()
+        stopping = threading.Event()
+        server = None
+        self.start()
+        try:
+            if self.__config.daemon["interval"] > 0:
+                threading.Thread(target=self.__tick, name="tick",
+                                 args=(triggers, stopping),
+                                 daemon=True).start()
+            if self.__config.daemon["watch"]:
+                threading.Thread(target=self.__watch, name="watch",
+                                 args=(triggers, stopping),
+                                 daemon=True).start()
+            if self.__config.daemon["socket"]:
+                server = self.__listen(triggers)
+            logging.info("Serving")
+            while True:
+                command, args, future = triggers.get()
+                if command == "stop":
+                    future.set_result({"stopped": True})
+                    break
+                try:
+                    future.set_result(self.__dispatch(command, args))
+                except Exception as e:
+                    logging.exception("Daemon " + command + " failed")
+                    future.set_exception(e)
+        finally:
+            stopping.set()
+            if server is not None:
+                server.shutdown()
+                server.server_close()
+                os.remove(self.__config.daemon["socket"])
+            while not triggers.empty():
+                triggers.get()[2].cancel()
+            self.stop()
+
+    def run(self, playlists=None, devices=None, stages=PIPELINE_STAGES):
         '''run'''
-        cls.__preparebasepaths()
-        for cls.__playlist in cls.__playlists:
-            cls.__updateytplaylist()
-        cls.__paralleladdsongtodb()
-        cls.__parallelcopyandtag()
-        cls.__parallelconvert()
-        cls.__parallelupdateautoplaylist()
-        cls.__parallelupdatecustomplaylist()
-        cls.__parallelupdatedevices()
+        self.start()
+        try:
+            self.sync(playlists, devices, stages)
+        finally:
+            self.stop()
 
 
 if __name__ == "__main__":
-    Syphon().run()
+    PARSER = argparse.ArgumentParser(
+        description="Download, condition and sync youtube playlists")
+    PARSER.add_argument("command", nargs="?", default="sync",
+                        choices=("sync", "daemon") + PIPELINE_STAGES,
+                        help="run every stage (default), serve as a " +
+                        "daemon or run a single stage")
+    PARSER.add_argument("-c", "--config", default=CFG_PATH,
+                        help="folder holding syphon.ini")
+    PARSER.add_argument("-p", "--playlist", action="append",
+                        help="only process this playlist, can be repeated")
+    PARSER.add_argument("-d", "--device", action="append",
+                        help="only update this device, can be repeated")
+    ARGS = PARSER.parse_args()
+    CONFIG = Config(ARGS.config)
+    if not CONFIG.load():
+        exit(-1)
+    if ARGS.command == "daemon":
+        Syphon(CONFIG).serve()
+    elif ARGS.command == "sync":
+        Syphon(CONFIG).run(ARGS.playlist, ARGS.device)
+    else:
+        Syphon(CONFIG).run(ARGS.playlist, ARGS.device, (ARGS.command,))
 
 
 #    @classmethod
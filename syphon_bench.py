@@ -0,0 +1,540 @@
+#!/usr/bin/python3
+"""
+Syphon benchmarks: time each stage and whole runs on synthetic playlists
+
+    Usage
+    -----
+    syphon_bench.py [--tracks N] [--only condition,fingerprint,...]
+
+    Fixtures are random melodies with leading and trailing silences and
+    varied loudness, generated once per set of parameters and served by a
+    stand-in youtube-dl and AcoustID server. Every run is appended to the
+    results file and compared with the last run of the same parameters on
+    the same host, so that regressions show up between versions.
+
+    License
+    -------
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+from argparse import ArgumentParser, SUPPRESS
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from multiprocessing import get_context
+from urllib.parse import parse_qs
+import hashlib
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import numpy as np
+from mutagen.oggvorbis import OggVorbis
+import syphon
+
+BENCHES = ("condition", "fingerprint", "index", "db", "refine", "e2e")
+
+# External tools each benchmark needs on top of the Python modules
+REQUIREMENTS = {
+    "condition": ("ffmpeg",),
+    "fingerprint": ("ffmpeg", "fpcalc"),
+    "e2e": ("ffmpeg", "fpcalc"),
+    }
+
+RATE = 44100
+
+# Chromaprint produces about 8 items per second of audio
+ITEMS_PER_SECOND = 8
+
+# Stand-in for youtube-dl: lists the fixtures of the playlist named by the
+# last component of the URL with --flat-playlist -j, and "downloads" the
+# fixtures named by video URLs, honouring the output template and --exec
+# like the real one
+FAKE_YOUTUBE_DL = '''
+import json
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+
+args = sys.argv[1:]
+fixtures = os.environ["SYPHON_BENCH_FIXTURES"]
+valued = ("-f", "-o", "--audio-format", "--exec", "--download-archive")
+
+
+def option(name, default=None):
+    return args[args.index(name) + 1] if name in args else default
+
+
+def find(url):
+    name = url.strip("'\\"").rstrip("/").split("/")[-1].split("=")[-1]
+    if os.path.isdir(os.path.join(fixtures, name)):
+        return sorted(os.path.join(fixtures, name, x)
+                      for x in os.listdir(os.path.join(fixtures, name)))
+    return [os.path.join(fixtures, playlist, x)
+            for playlist in sorted(os.listdir(fixtures))
+            if os.path.isdir(os.path.join(fixtures, playlist))
+            for x in os.listdir(os.path.join(fixtures, playlist))
+            if os.path.splitext(x)[0] == name][:1]
+
+
+urls = [x for i, x in enumerate(args)
+        if not x.startswith("-") and (i == 0 or args[i - 1] not in valued)]
+template = option("-o", "%(id)s.%(ext)s")
+command = option("--exec")
+entries = [x for url in urls for x in find(url)]
+for index, entry in enumerate(entries, 1):
+    title, ext = os.path.splitext(os.path.basename(entry))
+    if "--flat-playlist" in args:
+        print(json.dumps({"_type": "url", "ie_key": "Youtube", "id": title,
+                          "url": title, "title": title}), flush=True)
+        continue
+    print("[download] Downloading video %d of %d" % (index, len(entries)),
+          flush=True)
+    name = template.replace("%(playlist_index)s", str(index)) \\
+                   .replace("%(title)s", title) \\
+                   .replace("%(id)s", title) \\
+                   .replace("%(ext)s", ext[1:])
+    shutil.copyfile(entry, name)
+    if command:
+        subprocess.run(command.replace("{}", shlex.quote(name)), shell=True)
+'''
+
+
+class Fixtures():
+    '''Fixtures'''
+    def __init__(self, workdir, tracks, playlists, duration, lead, trail,
+                 duplicates, seed):
+        self.params = {"tracks": tracks, "playlists": playlists,
+                       "duration": duration, "lead": lead, "trail": trail,
+                       "duplicates": duplicates, "seed": seed}
+        digest = hashlib.sha1(json.dumps(self.params, sort_keys=True)
+                              .encode("utf-8")).hexdigest()
+        self.path = os.path.join(workdir, "fixtures-" + digest[:12])
+
+    def __melody(self, rng):
+        '''__melody'''
+        duration = self.params["duration"]
+        notes = []
+        while sum(len(x) for x in notes) < duration * RATE:
+            pitch = 440.0 * 2 ** ((rng.integers(45, 84) - 69) / 12.0)
+            length = int(rng.uniform(0.15, 0.6) * RATE)
+            notes.append(np.full(length, pitch))
+        freqs = np.concatenate(notes)[:int(duration * RATE)]
+        phase = 2 * np.pi * np.cumsum(freqs) / RATE
+        signal = np.sin(phase) + 0.5 * np.sin(2 * phase) + \
+            0.25 * np.sin(3 * phase)
+        return signal / np.abs(signal).max()
+
+    def __track(self, index):
+        '''__track'''
+        rng = np.random.default_rng([self.params["seed"], index])
+        source = index
+        if index > 0 and rng.random() < self.params["duplicates"]:
+            source = int(rng.integers(0, index))
+        melody = self.__melody(np.random.default_rng(
+            [self.params["seed"], source, 0]))
+        level = 10 ** (rng.uniform(-30, -3) / 20.0)
+        lead = np.zeros(int(rng.uniform(0, self.params["lead"]) * RATE))
+        trail = np.zeros(int(rng.uniform(0, self.params["trail"]) * RATE))
+        mono = np.concatenate([lead, melody * level, trail])
+        mono += rng.normal(0, 1e-5, len(mono))
+        return np.stack([mono, np.roll(mono, 7)], axis=1)
+
+    def __encode(self, index):
+        '''__encode'''
+        playlist = "pl" + str(index % self.params["playlists"])
+        dst = os.path.join(self.path, playlist, "track%05d.ogg" % index)
+        samples = self.__track(index)
+        command = ["ffmpeg", "-v", "error", "-y", "-f", "f32le",
+                   "-ar", str(RATE), "-ac", "2", "-i", "-",
+                   "-c:a", "libvorbis", "-q:a", "4", "-f", "ogg",
+                   dst + ".part"]
+        subprocess.run(command, input=samples.astype("<f4").tobytes(),
+                       check=True)
+        os.replace(dst + ".part", dst)
+
+    def generate(self, workers):
+        '''generate'''
+        marker = os.path.join(self.path, "complete")
+        if os.path.exists(marker):
+            return
+        for i in range(self.params["playlists"]):
+            os.makedirs(os.path.join(self.path, "pl" + str(i)),
+                        exist_ok=True)
+        print("Generating " + str(self.params["tracks"]) + " fixtures in " +
+              self.path)
+        with ThreadPoolExecutor(workers) as executor:
+            list(executor.map(self.__encode, range(self.params["tracks"])))
+        with open(marker, "w") as outfile:
+            outfile.write(json.dumps(self.params))
+
+    def playlists(self):
+        '''playlists'''
+        return ["pl" + str(i) for i in range(self.params["playlists"])]
+
+    def files(self):
+        '''files'''
+        return sorted(os.path.join(self.path, p, x)
+                      for p in self.playlists()
+                      for x in os.listdir(os.path.join(self.path, p)))
+
+
+class FakeAcoustID():
+    '''FakeAcoustID'''
+    class Handler(BaseHTTPRequestHandler):
+        '''Handler'''
+        def do_POST(self):
+            '''do_POST'''
+            length = int(self.headers["Content-Length"])
+            query = parse_qs(self.rfile.read(length).decode("ascii"))
+            fingerprints = []
+            for key, value in query.items():
+                if not key.startswith("fingerprint."):
+                    continue
+                digest = hashlib.sha1(value[0].encode("ascii")).hexdigest()
+                fingerprints.append({
+                    "index": key.split(".")[1],
+                    "results": [{"score": 1.0, "recordings": [{
+                        "title": "Bench " + digest[:10],
+                        "artists": [{"name": "Synth"}]}]}]})
+            body = json.dumps({"status": "ok",
+                               "fingerprints": fingerprints}).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            '''log_message'''
+
+    def __init__(self):
+        self.__server = HTTPServer(("127.0.0.1", 0), self.Handler)
+        self.url = "http://127.0.0.1:" + \
+            str(self.__server.server_port) + "/v2/lookup"
+
+    def start(self):
+        '''start'''
+        threading.Thread(target=self.__server.serve_forever,
+                         daemon=True).start()
+
+    def stop(self):
+        '''stop'''
+        self.__server.shutdown()
+        self.__server.server_close()
+
+
+class Bench():
+    '''Bench'''
+    @classmethod
+    def __pool(cls, workers):
+        '''__pool'''
+        return ProcessPoolExecutor(workers,
+                                   mp_context=get_context("forkserver"))
+
+    @classmethod
+    def __audioseconds(cls, files):
+        '''__audioseconds'''
+        return sum(OggVorbis(x).info.length for x in files)
+
+    @classmethod
+    def condition(cls, args, fixtures, workdir):
+        '''condition'''
+        files = fixtures.files()
+        outdir = os.path.join(workdir, "condition")
+        shutil.rmtree(outdir, ignore_errors=True)
+        os.makedirs(outdir)
+        dsts = [os.path.join(outdir, os.path.basename(x)) for x in files]
+        with cls.__pool(args.workers) as executor:
+            started = time.monotonic()
+            list(executor.map(syphon.Conditioner.condition, files, dsts,
+                              [args.gain] * len(files)))
+            wall = time.monotonic() - started
+        return {"wall_s": wall, "tracks_per_s": len(files) / wall,
+                "audio_s_per_s": cls.__audioseconds(files) / wall}
+
+    @classmethod
+    def fingerprint(cls, args, fixtures, workdir):
+        '''fingerprint'''
+        files = fixtures.files()
+        with cls.__pool(args.workers) as executor:
+            started = time.monotonic()
+            list(executor.map(syphon.Fingerprinter.fingerprint, files))
+            wall = time.monotonic() - started
+        return {"wall_s": wall, "tracks_per_s": len(files) / wall,
+                "audio_s_per_s": cls.__audioseconds(files) / wall}
+
+    @classmethod
+    def index(cls, args, fixtures, workdir):
+        '''index'''
+        results = {}
+        rng = np.random.default_rng(args.seed)
+        length = int(args.duration * ITEMS_PER_SECOND)
+        for size in args.library_sizes:
+            prints = rng.integers(0, 2 ** 32, (size, length),
+                                  dtype=np.uint32)
+            index = syphon.FingerprintIndex(args.index_stride,
+                                            args.similarity)
+            started = time.monotonic()
+            for i in range(size):
+                index.add(str(i), prints[i])
+            added = time.monotonic() - started
+            queries = [prints[i] ^ (rng.random(length) < 0.02).astype(
+                np.uint32) for i in rng.integers(0, size, 100)]
+            queries += list(rng.integers(0, 2 ** 32, (100, length),
+                                         dtype=np.uint32))
+            started = time.monotonic()
+            for query in queries:
+                index.match(query)
+            matched = time.monotonic() - started
+            results["add_" + str(size) + "_per_s"] = size / added
+            results["match_" + str(size) + "_per_s"] = len(queries) / matched
+        return results
+
+    @classmethod
+    def db(cls, args, fixtures, workdir):
+        '''db'''
+        dbfile = os.path.join(workdir, "ingest.db")
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(dbfile + suffix):
+                os.remove(dbfile + suffix)
+        syphon.Schema.migrate(dbfile)
+        database = syphon.Database(dbfile, args.batch_rows,
+                                   args.batch_ms / 1000.0, 1)
+        database.start()
+        started = time.monotonic()
+        for i in range(args.rows):
+            database.write('INSERT INTO Songs("Input File Name", Title, '
+                           'Artists) VALUES(?, ?, ?)',
+                           ("%06d-track.ogg" % i, "Title " + str(i),
+                            "Artist " + str(i % 97)))
+        database.flush()
+        wall = time.monotonic() - started
+        started = time.monotonic()
+        database.query('SELECT "Input File Name", Title, Artists FROM Songs')
+        loaded = time.monotonic() - started
+        database.stop()
+        return {"ingest_rows_per_s": args.rows / wall, "load_s": loaded}
+
+    @classmethod
+    def refine(cls, args, fixtures, workdir):
+        '''refine'''
+        results = {}
+        for size in args.library_sizes:
+            songs = [{"in": "%06d-track.ogg" % i,
+                      "title": "Title " + str(i - i % 10 if i % 7 else i),
+                      "artists": "Artist " + str(i % 97)}
+                     for i in range(size)]
+            started = time.monotonic()
+            catalog = syphon.Catalog(songs)
+            built = time.monotonic() - started
+            started = time.monotonic()
+            playlist = [catalog.mp3name(x["in"]) for x in songs]
+            playlist = [x for x in playlist if catalog.bymp3(x) is not None]
+            refined = time.monotonic() - started
+            results["catalog_" + str(size) + "_s"] = built
+            results["refine_" + str(size) + "_s"] = refined
+        return results
+
+    @classmethod
+    def __writeconfig(cls, args, fixtures, cfgdir, basepath, acoustid):
+        '''__writeconfig'''
+        with open(os.path.join(cfgdir, "syphon.ini"), "w") as outfile:
+            outfile.write("[GLOBAL]\nTARGET_GAIN = " + str(args.gain) +
+                          "\nMAX_THREADS = " + str(args.workers) +
+                          "\nBASE_PATH = " + basepath + "\n\n" +
+                          "[ACOUSTID]\nURL = " + acoustid.url + "\n\n" +
+                          "[METRICS]\nREPORT = report.json\n")
+        with open(os.path.join(cfgdir, "syphon_key.ini"), "w") as outfile:
+            outfile.write("[KEY]\nVALUE = bench\n")
+        with open(os.path.join(cfgdir, "syphon_urls.ini"), "w") as outfile:
+            for playlist in fixtures.playlists():
+                outfile.write("[" + playlist + "]\nURL = bench.invalid/" +
+                              playlist + "\nACTIVE = True\n\n")
+        with open(os.path.join(cfgdir, "syphon_devices.ini"), "w") as outfile:
+            outfile.write("[bench]\nPLAYLISTS = " +
+                          " ".join(fixtures.playlists()) + "\n")
+
+    @classmethod
+    def __runsyphon(cls, cfgdir, basepath, env):
+        '''__runsyphon'''
+        started = time.monotonic()
+        subprocess.run([sys.executable, os.path.abspath(__file__),
+                        "--syphon", cfgdir], env=env, check=True)
+        wall = time.monotonic() - started
+        with open(os.path.join(basepath, "report.json")) as infile:
+            return wall, json.load(infile)
+
+    @classmethod
+    def e2e(cls, args, fixtures, workdir):
+        '''e2e'''
+        root = os.path.join(workdir, "e2e")
+        shutil.rmtree(root, ignore_errors=True)
+        cfgdir = os.path.join(root, "cfg")
+        basepath = os.path.join(root, "library")
+        bindir = os.path.join(root, "bin")
+        for path in (cfgdir, basepath, bindir):
+            os.makedirs(path)
+        fake = os.path.join(bindir, "youtube-dl")
+        with open(fake, "w") as outfile:
+            outfile.write("#!" + sys.executable + "\n" + FAKE_YOUTUBE_DL)
+        os.chmod(fake, 0o755)
+        env = dict(os.environ, SYPHON_BENCH_FIXTURES=fixtures.path,
+                   PATH=bindir + os.pathsep + os.environ.get("PATH", ""))
+        acoustid = FakeAcoustID()
+        acoustid.start()
+        try:
+            cls.__writeconfig(args, fixtures, cfgdir, basepath, acoustid)
+            cold, report = cls.__runsyphon(cfgdir, basepath, env)
+            warm, warmreport = cls.__runsyphon(cfgdir, basepath, env)
+        finally:
+            acoustid.stop()
+        results = {"cold_s": cold, "warm_s": warm}
+        for stage, entry in sorted(report["stages"].items()):
+            results["cold_" + stage + "_s"] = entry["wall"]
+        results["cold_cpu_s"] = report["cpu"] + report["childrencpu"]
+        results["warm_cpu_s"] = warmreport["cpu"] + warmreport["childrencpu"]
+        return results
+
+
+def version():
+    '''version'''
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"],
+                              cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def previous(path, record):
+    '''previous'''
+    if not os.path.exists(path):
+        return None
+    last = None
+    with open(path) as infile:
+        for line in infile:
+            stored = json.loads(line)
+            if stored["host"] == record["host"] and \
+               stored["params"] == record["params"]:
+                last = stored
+    return last
+
+
+def compare(last, record, tolerance):
+    '''compare'''
+    regressions = 0
+    for bench, metrics in sorted(record["results"].items()):
+        before = {} if last is None else last["results"].get(bench, {})
+        for metric, value in sorted(metrics.items()):
+            line = "%-12s %-32s %12.4f" % (bench, metric, value)
+            if before.get(metric):
+                change = value / before[metric] - 1
+                worse = -change if metric.endswith("_per_s") else change
+                line += "  %+7.1f%% vs %s" % (change * 100, last["version"])
+                if worse > tolerance:
+                    line += "  REGRESSION"
+                    regressions += 1
+            print(line)
+    return regressions
+
+
+def parseargs():
+    '''parseargs'''
+    parser = ArgumentParser(description="Benchmark syphon stages and runs")
+    parser.add_argument("--only", default=",".join(BENCHES),
+                        help="comma separated benchmarks among " +
+                        ", ".join(BENCHES))
+    parser.add_argument("--workdir", default=os.path.join(
+        tempfile.gettempdir(), "syphon-bench"))
+    parser.add_argument("--results", default="syphon_bench.jsonl")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="relative slowdown reported as a regression")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--tracks", type=int, default=50)
+    parser.add_argument("--playlists", type=int, default=2)
+    parser.add_argument("--duration", type=float, default=30,
+                        help="seconds of music in each track")
+    parser.add_argument("--lead", type=float, default=5,
+                        help="longest leading silence in seconds")
+    parser.add_argument("--trail", type=float, default=5,
+                        help="longest trailing silence in seconds")
+    parser.add_argument("--duplicates", type=float, default=0.1,
+                        help="fraction of tracks repeating an earlier one")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--gain", type=int, default=-12)
+    parser.add_argument("--library-sizes", default="1000,10000,50000",
+                        type=lambda x: [int(y) for y in x.split(",")])
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--batch-rows", type=int, default=500)
+    parser.add_argument("--batch-ms", type=int, default=200)
+    parser.add_argument("--index-stride", type=int, default=4)
+    parser.add_argument("--similarity", type=float, default=0.85)
+    # Internal: run syphon itself with the configuration in this directory
+    parser.add_argument("--syphon", help=SUPPRESS)
+    return parser.parse_args()
+
+
+def main():
+    '''main'''
+    args = parseargs()
+    if args.syphon:
+        config = syphon.Config(args.syphon)
+        if not config.load():
+            return -1
+        syphon.Syphon(config).run()
+        return 0
+    benches = [x for x in args.only.split(",") if x]
+    for bench in benches:
+        if bench not in BENCHES:
+            print("Unknown benchmark " + bench)
+            return 2
+    os.makedirs(args.workdir, exist_ok=True)
+    fixtures = Fixtures(args.workdir, args.tracks, args.playlists,
+                        args.duration, args.lead, args.trail,
+                        args.duplicates, args.seed)
+    params = dict(vars(args))
+    for key in ("only", "workdir", "results", "tolerance", "syphon"):
+        del params[key]
+    record = {"version": version(), "timestamp": time.time(),
+              "host": platform.node(), "python": platform.python_version(),
+              "params": params, "results": {}}
+    for bench in benches:
+        missing = [x for x in REQUIREMENTS.get(bench, ())
+                   if shutil.which(x) is None]
+        if missing:
+            print("Skipping " + bench + ", missing " + ", ".join(missing))
+            continue
+        if bench in REQUIREMENTS:
+            fixtures.generate(args.workers)
+        print("Running " + bench)
+        record["results"][bench] = getattr(Bench, bench)(args, fixtures,
+                                                         args.workdir)
+    last = previous(args.results, record)
+    regressions = compare(last, record, args.tolerance)
+    with open(args.results, "a") as outfile:
+        outfile.write(json.dumps(record, sort_keys=True) + "\n")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,65 @@
+import unittest
+
+import syphon
+
+
+class CatalogTest(unittest.TestCase):
+    '''CatalogTest'''
+    def catalog(self):
+        '''catalog'''
+        return syphon.Catalog([
+            {"in": "a.ogg", "title": "Song", "artists": "Artist"},
+            {"in": "b.ogg", "title": "Song", "artists": "Artist"},
+            {"in": "c.ogg", "title": "Other", "artists": "Artist"}])
+
+    def test_owner(self):
+        '''test_owner'''
+        catalog = self.catalog()
+        self.assertIs(catalog.canonical("a.ogg"), catalog.get("a.ogg"))
+        self.assertIsNone(catalog.canonical("b.ogg"))
+        self.assertIs(catalog.bymp3("Song _ Artist.mp3"),
+                      catalog.get("a.ogg"))
+
+    def test_retitle_owner(self):
+        '''test_retitle_owner'''
+        catalog = self.catalog()
+        catalog.settitle("a.ogg", "New", "Artist")
+        # The duplicate takes over the title the owner gave up
+        self.assertIs(catalog.canonical("b.ogg"), catalog.get("b.ogg"))
+        self.assertIs(catalog.bymp3("Song _ Artist.mp3"),
+                      catalog.get("b.ogg"))
+        self.assertIs(catalog.bymp3("New _ Artist.mp3"),
+                      catalog.get("a.ogg"))
+        self.assertIs(catalog.canonical("a.ogg"), catalog.get("a.ogg"))
+
+    def test_retitle_single(self):
+        '''test_retitle_single'''
+        catalog = self.catalog()
+        catalog.settitle("c.ogg", "Renamed", "Artist")
+        self.assertIsNone(catalog.bymp3("Other _ Artist.mp3"))
+        self.assertIs(catalog.bymp3("Renamed _ Artist.mp3"),
+                      catalog.get("c.ogg"))
+        catalog.settitle("a.ogg", "Other", "Artist")
+        self.assertIs(catalog.canonical("a.ogg"), catalog.get("a.ogg"))
+
+    def test_retitle_duplicate(self):
+        '''test_retitle_duplicate'''
+        catalog = self.catalog()
+        catalog.settitle("b.ogg", "Other", "Artist")
+        self.assertIs(catalog.bymp3("Song _ Artist.mp3"),
+                      catalog.get("a.ogg"))
+        self.assertIs(catalog.bymp3("Other _ Artist.mp3"),
+                      catalog.get("c.ogg"))
+        self.assertIsNone(catalog.canonical("b.ogg"))
+
+    def test_new(self):
+        '''test_new'''
+        catalog = self.catalog()
+        catalog.settitle("d.ogg", "Fresh", "Artist")
+        catalog.settitle("d.ogg", "Fresh", "Artist")
+        self.assertIs(catalog.canonical("d.ogg"), catalog.get("d.ogg"))
+        self.assertEqual(catalog.mp3name("d.ogg"), "Fresh _ Artist.mp3")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,114 @@
+import unittest
+
+import numpy as np
+
+import syphon
+
+Conditioner = syphon.Conditioner
+
+
+def silencebounds(samples, rate):
+    '''silencebounds, trimming a whole track decoded in memory'''
+    window = max(1, int(rate * syphon.SILENCE_WINDOW))
+    frames = len(samples) // window
+    if frames == 0:
+        return 0, len(samples)
+    rms = Conditioner._Conditioner__windowrms(samples, window)
+    above = rms > Conditioner._Conditioner__parsethreshold(
+        syphon.SILENCE_THRESHOLD)
+    if not above.any():
+        return 0, len(samples)
+    length = max(1, -(-Conditioner._Conditioner__parseduration(
+        syphon.SILENCE_DURATION, rate) // window))
+
+    def firstrun(above):
+        run = Conditioner._Conditioner__findrun(above, length)
+        return int(np.flatnonzero(above)[0]) if run is None else run
+    tail = firstrun(above[::-1])
+    end = len(samples) if tail == 0 else (frames - tail) * window
+    return firstrun(above) * window, end
+
+
+class StreamRmsTest(unittest.TestCase):
+    '''StreamRmsTest'''
+    def streamrms(self, sizes, window, channels=2):
+        '''streamrms'''
+        rng = np.random.default_rng(sum(sizes))
+        samples = rng.normal(0, 0.1, (sum(sizes), channels)).astype("<f4")
+        bounds = np.cumsum([0] + sizes)
+        chunks = [samples[bounds[i]:bounds[i + 1]] for i in range(len(sizes))]
+        rms = list(Conditioner._Conditioner__streamrms(chunks, window, None))
+        whole = Conditioner._Conditioner__windowrms(samples, window)
+        np.testing.assert_allclose(np.concatenate([np.zeros(0)] + rms),
+                                   whole)
+
+    def test_short_tail(self):
+        '''test_short_tail'''
+        self.streamrms([262144, 100], 960)
+
+    def test_empty_tail(self):
+        '''test_empty_tail'''
+        self.streamrms([1000, 0], 960)
+
+    def test_shorter_than_window(self):
+        '''test_shorter_than_window'''
+        self.streamrms([10, 20, 30], 960)
+
+    def test_uneven_chunks(self):
+        '''test_uneven_chunks'''
+        self.streamrms([777, 1, 2000, 959, 961], 960, channels=1)
+
+
+class StreamBoundsTest(unittest.TestCase):
+    '''StreamBoundsTest'''
+    RATE = 1000
+
+    def setUp(self):
+        self.saved = (syphon.SILENCE_DURATION, syphon.CONDITIONER_TAIL,
+                      Conditioner._Conditioner__stream)
+        syphon.SILENCE_DURATION = "0.5"
+        syphon.CONDITIONER_TAIL = 1
+
+    def tearDown(self):
+        (syphon.SILENCE_DURATION, syphon.CONDITIONER_TAIL,
+         Conditioner._Conditioner__stream) = self.saved
+
+    def fakestream(self, samples, chunk):
+        '''fakestream'''
+        def stream(cls, src, channels, rate, offset=0, length=None):
+            end = len(samples) if length is None else offset + length
+            for position in range(offset, end, chunk):
+                yield samples[position:min(position + chunk, end)]
+        Conditioner._Conditioner__stream = classmethod(stream)
+
+    def streambounds(self, samples):
+        '''streambounds'''
+        window = max(1, int(self.RATE * syphon.SILENCE_WINDOW))
+        length = -(-Conditioner._Conditioner__parseduration(
+            syphon.SILENCE_DURATION, self.RATE) // window)
+        bounds = ("src", samples.shape[1], self.RATE, None, window,
+                  max(1, length),
+                  Conditioner._Conditioner__parsethreshold(
+                      syphon.SILENCE_THRESHOLD))
+        start = Conditioner._Conditioner__findstart(*bounds)
+        if start is None:
+            return 0, len(samples)
+        end = Conditioner._Conditioner__findend(*bounds, start,
+                                                len(samples) / self.RATE)
+        return start, len(samples) if end is None else end
+
+    def test_matches_memory(self):
+        '''test_matches_memory'''
+        rng = np.random.default_rng(25)
+        for _ in range(300):
+            parts = [rng.normal(0, rng.choice([0.0, 0.001, 0.2]),
+                                (int(rng.integers(1, 1500)), 2))
+                     for _ in range(int(rng.integers(1, 8)))]
+            samples = np.concatenate(parts).astype("<f4")
+            self.fakestream(samples, int(rng.integers(1, 3000)))
+            self.assertEqual(self.streambounds(samples),
+                             silencebounds(samples, self.RATE))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,108 @@
+import os
+import sqlite3
+import tempfile
+import threading
+import unittest
+
+import syphon
+
+
+class DatabaseTest(unittest.TestCase):
+    '''DatabaseTest'''
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dbfile = os.path.join(self.tmp.name, "syphon.db")
+        syphon.Schema.migrate(self.dbfile)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def database(self, batchrows=100, batchtime=0.05):
+        '''database'''
+        db = syphon.Database(self.dbfile, batchrows, batchtime, 2)
+        db.start()
+        return db
+
+    def insert(self, db, name):
+        '''insert'''
+        return db.write('INSERT INTO Songs("Input File Name") VALUES(?)',
+                        (name,))
+
+    def names(self, db):
+        '''names'''
+        return sorted(x[0] for x in db.query('SELECT "Input File Name" ' +
+                                             'FROM Songs'))
+
+    def test_flush(self):
+        '''test_flush'''
+        db = self.database(batchtime=10)
+        try:
+            futures = [self.insert(db, str(i)) for i in range(5)]
+            self.assertTrue(db.flush())
+            self.assertEqual([x.result(timeout=0) for x in futures], [1] * 5)
+            self.assertEqual(self.names(db), [str(i) for i in range(5)])
+        finally:
+            db.stop()
+
+    def test_batch(self):
+        '''test_batch'''
+        db = self.database(batchrows=3, batchtime=10)
+        try:
+            futures = [self.insert(db, str(i)) for i in range(3)]
+            # A full batch commits without waiting for the batch time
+            self.assertEqual([x.result(timeout=5) for x in futures], [1] * 3)
+            self.assertEqual(self.names(db), ["0", "1", "2"])
+        finally:
+            db.stop()
+
+    def test_stop(self):
+        '''test_stop'''
+        db = self.database(batchtime=10)
+        futures = [self.insert(db, str(i)) for i in range(10)]
+        db.stop()
+        self.assertTrue(all(x.done() for x in futures))
+        con = sqlite3.connect(self.dbfile)
+        try:
+            self.assertEqual(con.execute('SELECT COUNT(*) FROM Songs')
+                             .fetchone()[0], 10)
+        finally:
+            con.close()
+
+    def test_integrity(self):
+        '''test_integrity'''
+        db = self.database(batchtime=10)
+        try:
+            first = self.insert(db, "a")
+            duplicate = self.insert(db, "a")
+            other = self.insert(db, "b")
+            db.flush()
+            self.assertEqual(first.result(timeout=0), 1)
+            self.assertIsInstance(duplicate.exception(timeout=0),
+                                  sqlite3.IntegrityError)
+            # The failing statement does not roll back the rest of the batch
+            self.assertEqual(other.result(timeout=0), 1)
+            self.assertEqual(self.names(db), ["a", "b"])
+        finally:
+            db.stop()
+
+    def test_concurrent(self):
+        '''test_concurrent'''
+        db = self.database(batchrows=7, batchtime=0.01)
+        try:
+            def writer(prefix):
+                for i in range(50):
+                    self.insert(db, prefix + str(i))
+            threads = [threading.Thread(target=writer, args=(str(x) + "-",))
+                       for x in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            db.flush()
+            self.assertEqual(len(self.names(db)), 200)
+        finally:
+            db.stop()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,54 @@
+import os
+import tempfile
+import unittest
+
+import syphon
+
+
+class EncoderTest(unittest.TestCase):
+    '''EncoderTest'''
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.commands = []
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def run_command(self, command, metrics=None):
+        '''run_command'''
+        self.commands.append(command)
+        for path in command:
+            if path.endswith(".part") and "missing" not in path:
+                open(path, "w").close()
+        return syphon.CommandResult(command=command, returncode=0,
+                                    output="", err="", elapsed=4.0,
+                                    waited=0.0, progress={},
+                                    usage={"cpu": 2.0, "read": 8,
+                                           "written": 4})
+
+    def test_batch(self):
+        '''test_batch'''
+        encoder = syphon.Encoder(1, 4, 0.2, self.run_command)
+        first, second = syphon.Metrics(), syphon.Metrics()
+        owners = [first, first, second, None]
+        names = ["a", "b", "missing", "c"]
+        futures = [encoder.encode(name, os.path.join(self.tmp.name, name),
+                                  ["-f", "mp3"], {}, metrics)
+                   for name, metrics in zip(names, owners)]
+        encoder.start()
+        try:
+            results = {name: future.exception(timeout=5) or future.result()
+                       for name, future in zip(names, futures)}
+        finally:
+            encoder.stop()
+        self.assertEqual(len(self.commands), 1)
+        self.assertIsInstance(results.pop("missing"), FileNotFoundError)
+        self.assertEqual(results, {"a": 0, "b": 0, "c": 0})
+        self.assertTrue(os.path.exists(os.path.join(self.tmp.name, "a")))
+        stages = [x.report()["stages"]["command"] for x in (first, second)]
+        self.assertEqual([x["wall"] for x in stages], [2.0, 1.0])
+        self.assertEqual([x["cpu"] for x in stages], [1.0, 0.5])
+
+
+if __name__ == "__main__":
+    unittest.main()
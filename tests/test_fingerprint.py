@@ -0,0 +1,118 @@
+import base64
+import unittest
+
+import numpy as np
+
+import syphon
+
+
+def pack(values, width):
+    '''pack'''
+    bits = []
+    for value in values:
+        bits += [(value >> i) & 1 for i in range(width)]
+    bits += [0] * (-len(bits) % 8)
+    return bytes(sum(bits[i + j] << j for j in range(8))
+                 for i in range(0, len(bits), 8))
+
+
+def compress(raw, algorithm=1):
+    '''compress, ported from chromaprint's FingerprintCompressor'''
+    bits = []
+    previous = 0
+    for item in raw:
+        x = int(item) ^ previous
+        previous = int(item)
+        bit, last = 1, 0
+        while x:
+            if x & 1:
+                bits.append(bit - last)
+                last = bit
+            x >>= 1
+            bit += 1
+        bits.append(0)
+    data = bytes([algorithm, (len(raw) >> 16) & 255, (len(raw) >> 8) & 255,
+                  len(raw) & 255])
+    data += pack([min(x, 7) for x in bits], 3)
+    data += pack([x - 7 for x in bits if x >= 7], 5)
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+class DecodeTest(unittest.TestCase):
+    '''DecodeTest'''
+    def roundtrip(self, raw, algorithm=1):
+        '''roundtrip'''
+        raw = np.asarray(raw, dtype=np.uint32)
+        decoded = syphon.Fingerprinter.decode(compress(raw, algorithm))
+        self.assertEqual(decoded[0], algorithm)
+        np.testing.assert_array_equal(decoded[1], raw)
+
+    def test_empty(self):
+        '''test_empty'''
+        self.roundtrip([])
+
+    def test_edges(self):
+        '''test_edges'''
+        self.roundtrip([0, 1, 0x80000000, 0xffffffff, 0, 0x40, 0x41], 2)
+
+    def test_random(self):
+        '''test_random'''
+        rng = np.random.default_rng(9)
+        for length in (1, 7, 100, 1000):
+            self.roundtrip(rng.integers(0, 2 ** 32, length,
+                                        dtype=np.uint32))
+
+    def test_sparse(self):
+        '''test_sparse'''
+        # Few set bits give long gaps, stored as exceptional 5 bit values
+        rng = np.random.default_rng(10)
+        raw = np.bitwise_xor.accumulate(
+            np.uint32(1) << rng.integers(0, 32, 500).astype(np.uint32))
+        self.roundtrip(raw)
+
+    def test_bytes(self):
+        '''test_bytes'''
+        raw = np.arange(50, dtype=np.uint32) * 2654435761
+        encoded = compress(raw).encode("ascii")
+        np.testing.assert_array_equal(
+            syphon.Fingerprinter.decode(encoded)[1], raw)
+
+    def test_truncated(self):
+        '''test_truncated'''
+        encoded = compress(np.arange(1, 100, dtype=np.uint32))
+        with self.assertRaises(ValueError):
+            syphon.Fingerprinter.decode(encoded[:20])
+
+
+class FingerprintIndexTest(unittest.TestCase):
+    '''FingerprintIndexTest'''
+    def test_match(self):
+        '''test_match'''
+        rng = np.random.default_rng(11)
+        prints = rng.integers(0, 2 ** 32, (300, 240), dtype=np.uint32)
+        index = syphon.FingerprintIndex(4, 0.85)
+        for i, raw in enumerate(prints):
+            noisy = raw ^ (rng.random(240) < 0.02).astype(np.uint32)
+            if i > 0:
+                target = int(rng.integers(0, i))
+                match = index.match(prints[target] ^ (
+                    rng.random(240) < 0.02).astype(np.uint32))
+                self.assertEqual(match[0], str(target))
+            self.assertIsNone(index.match(
+                rng.integers(0, 2 ** 32, 240, dtype=np.uint32)))
+            index.add(str(i), raw)
+            self.assertEqual(index.match(noisy)[0], str(i))
+
+    def test_shifted(self):
+        '''test_shifted'''
+        rng = np.random.default_rng(12)
+        raw = rng.integers(0, 2 ** 32, 400, dtype=np.uint32)
+        index = syphon.FingerprintIndex(4, 0.85)
+        index.add("song", raw)
+        match = index.match(raw[37:])
+        self.assertEqual(match[0], "song")
+        self.assertGreater(match[1], 0.99)
+
+
+if __name__ == "__main__":
+    unittest.main()
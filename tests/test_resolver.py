@@ -0,0 +1,134 @@
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+import syphon
+
+
+class AcoustIDHandler(BaseHTTPRequestHandler):
+    '''AcoustIDHandler'''
+    def do_POST(self):
+        '''do_POST'''
+        length = int(self.headers["Content-Length"])
+        params = parse_qs(self.rfile.read(length).decode("ascii"))
+        self.server.requests.append((time.monotonic(), params))
+        answers = []
+        i = 0
+        while "fingerprint." + str(i) in params:
+            # Fingerprints are "title:score[:title:score...]"
+            fields = params["fingerprint." + str(i)][0].split(":")
+            answers.append({"index": i, "results": [
+                {"score": float(score), "recordings": [
+                    {"title": title, "artists": [{"name": "Artist"}]}]}
+                for title, score in zip(fields[::2], fields[1::2])]})
+            i += 1
+        body = json.dumps({"status": "ok",
+                           "fingerprints": answers}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        '''log_message'''
+
+
+class ResolverTest(unittest.TestCase):
+    '''ResolverTest'''
+    def setUp(self):
+        self.wait = syphon.RESOLVER_WAIT
+        syphon.RESOLVER_WAIT = 0.05
+        self.tmp = tempfile.TemporaryDirectory()
+        dbfile = os.path.join(self.tmp.name, "syphon.db")
+        syphon.Schema.migrate(dbfile)
+        self.db = syphon.Database(dbfile, 100, 0.01, 2)
+        self.db.start()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), AcoustIDHandler)
+        self.server.requests = []
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+        self.url = "http://127.0.0.1:" + str(self.server.server_port) + "/"
+        self.resolvers = []
+
+    def tearDown(self):
+        for resolver in self.resolvers:
+            resolver.stop()
+        self.server.shutdown()
+        self.server.server_close()
+        self.db.stop()
+        self.tmp.cleanup()
+        syphon.RESOLVER_WAIT = self.wait
+
+    def resolver(self, batch=10, rate=100.0, ttl=3600, minscore=0.5):
+        '''resolver'''
+        resolver = syphon.Resolver(self.url, "key", batch, rate, ttl,
+                                   minscore, self.db)
+        resolver.start()
+        self.resolvers.append(resolver)
+        return resolver
+
+    def lookup(self, resolver, fingerprints):
+        '''lookup'''
+        futures = [resolver.lookup(180, x) for x in fingerprints]
+        results = [x.result(timeout=10) for x in futures]
+        self.db.flush()
+        return results
+
+    def test_batch(self):
+        '''test_batch'''
+        results = self.lookup(self.resolver(batch=3),
+                              ["t" + str(i) + ":0.9" for i in range(5)])
+        self.assertEqual(results, [("t" + str(i), "Artist")
+                                   for i in range(5)])
+        self.assertEqual([len([x for x in params
+                               if x.startswith("fingerprint.")])
+                          for stamp, params in self.server.requests], [3, 2])
+        self.assertEqual(self.server.requests[0][1]["client"], ["key"])
+        self.assertEqual(self.server.requests[0][1]["duration.0"], ["180"])
+
+    def test_rate(self):
+        '''test_rate'''
+        self.lookup(self.resolver(batch=1, rate=5.0),
+                    ["t" + str(i) + ":0.9" for i in range(3)])
+        stamps = [stamp for stamp, params in self.server.requests]
+        self.assertEqual(len(stamps), 3)
+        for before, after in zip(stamps, stamps[1:]):
+            self.assertGreaterEqual(after - before, 0.18)
+
+    def test_cache(self):
+        '''test_cache'''
+        self.lookup(self.resolver(), ["a:0.9", "b:0.9"])
+        self.assertEqual(len(self.server.requests), 1)
+        results = self.lookup(self.resolver(), ["a:0.9", "b:0.9", "c:0.9"])
+        self.assertEqual(results, [("a", "Artist"), ("b", "Artist"),
+                                   ("c", "Artist")])
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(self.server.requests[1][1]["fingerprint.0"],
+                         ["c:0.9"])
+
+    def test_expired(self):
+        '''test_expired'''
+        self.lookup(self.resolver(ttl=0), ["a:0.9"])
+        self.lookup(self.resolver(ttl=0), ["a:0.9"])
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_minscore(self):
+        '''test_minscore'''
+        results = self.lookup(self.resolver(minscore=0.5),
+                              ["low:0.4", "low:0.3:high:0.8", ""])
+        self.assertEqual(results, [None, ("high", "Artist"), None])
+
+    def test_unreachable(self):
+        '''test_unreachable'''
+        self.url = "http://127.0.0.1:1/"
+        self.assertEqual(self.lookup(self.resolver(), ["a:0.9"]), [None])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,107 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+
+import syphon
+
+
+class SchemaTest(unittest.TestCase):
+    '''SchemaTest'''
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dbfile = os.path.join(self.tmp.name, "syphon.db")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def execute(self, *statements):
+        '''execute'''
+        con = sqlite3.connect(self.dbfile)
+        try:
+            results = [con.execute(*x).fetchall() for x in statements]
+            con.commit()
+            return results
+        finally:
+            con.close()
+
+    def baseline(self):
+        '''baseline, the tables written before the schema was versioned'''
+        self.execute(
+            ('CREATE TABLE Songs("Input File Name" TEXT PRIMARY KEY, ' +
+             'AcoustID BLOB, Title TEXT, Artists TEXT)',),
+            ('CREATE TABLE Playlists(Playlist TEXT PRIMARY KEY, Type TEXT, ' +
+             'Songs TEXT)',),
+            ('INSERT INTO Songs VALUES(?, ?, ?, ?)',
+             ("a.ogg", b"fp", "A", "Artist")),
+            ('INSERT INTO Playlists VALUES(?, ?, ?)',
+             ("mix", "youtube", str(["a.ogg", "b.ogg", "it's.ogg"]))),
+            ('INSERT INTO Playlists VALUES(?, ?, ?)',
+             ("empty", "youtube", str([]))),
+            ('INSERT INTO Playlists VALUES(?, ?, ?)',
+             ("broken", "youtube", "['a.ogg'")))
+
+    def test_baseline(self):
+        '''test_baseline'''
+        self.baseline()
+        syphon.Schema.migrate(self.dbfile)
+        version, entries, playlists, songs, indexes = self.execute(
+            ('PRAGMA user_version',),
+            ('SELECT Playlist, Position, Song FROM PlaylistEntries ' +
+             'ORDER BY Playlist, Position',),
+            ('SELECT Playlist, Songs FROM Playlists ORDER BY Playlist',),
+            ('SELECT * FROM Songs',),
+            ('SELECT name FROM sqlite_master WHERE type = "index" ' +
+             'AND name NOT LIKE "sqlite_%" ORDER BY name',))
+        self.assertEqual(version, [(3,)])
+        self.assertEqual(entries, [("mix", 0, "a.ogg"), ("mix", 1, "b.ogg"),
+                                   ("mix", 2, "it's.ogg")])
+        self.assertEqual(playlists, [("broken", None), ("empty", None),
+                                     ("mix", None)])
+        self.assertEqual(songs, [("a.ogg", b"fp", "A", "Artist")])
+        self.assertEqual([x[0] for x in indexes],
+                         ["CacheByLastUsed", "EntriesBySong",
+                          "FingerprintsByDuplicate", "SongsByTitle",
+                          "TracksByStatus", "VideosByVideo"])
+
+    def test_fresh(self):
+        '''test_fresh'''
+        syphon.Schema.migrate(self.dbfile)
+        tables = self.execute(('SELECT name FROM sqlite_master ' +
+                               'WHERE type = "table"',))[0]
+        self.assertIn(("PlaylistEntries",), tables)
+        self.assertIn(("Tracks",), tables)
+
+    def test_idempotent(self):
+        '''test_idempotent'''
+        self.baseline()
+        syphon.Schema.migrate(self.dbfile)
+        self.execute(('INSERT INTO PlaylistEntries VALUES(?, ?, ?)',
+                      ("mix", 3, "c.ogg")),)
+        syphon.Schema.migrate(self.dbfile)
+        self.assertEqual(self.execute(('SELECT COUNT(*) FROM ' +
+                                       'PlaylistEntries',))[0], [(4,)])
+
+    def test_newer(self):
+        '''test_newer'''
+        self.execute(('PRAGMA user_version = 4',))
+        with self.assertRaises(RuntimeError):
+            syphon.Schema.migrate(self.dbfile)
+        self.assertEqual(self.execute(('PRAGMA user_version',))[0], [(4,)])
+
+    def test_rollback(self):
+        '''test_rollback'''
+        self.baseline()
+        self.execute(('PRAGMA user_version = 1',),
+                     ('CREATE TABLE PlaylistEntries(Song TEXT)',))
+        with self.assertRaises(sqlite3.OperationalError):
+            syphon.Schema.migrate(self.dbfile)
+        version, playlists = self.execute(
+            ('PRAGMA user_version',),
+            ('SELECT Songs FROM Playlists WHERE Playlist = "mix"',))
+        self.assertEqual(version, [(1,)])
+        self.assertEqual(playlists, [(str(["a.ogg", "b.ogg", "it's.ogg"]),)])
+
+
+if __name__ == "__main__":
+    unittest.main()
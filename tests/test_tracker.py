@@ -0,0 +1,121 @@
+import os
+import tempfile
+import types
+import unittest
+
+import syphon
+
+
+class TrackerTest(unittest.TestCase):
+    '''TrackerTest'''
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        dbfile = os.path.join(self.tmp.name, "syphon.db")
+        syphon.Schema.migrate(dbfile)
+        self.db = syphon.Database(dbfile, 100, 0.01, 2)
+        self.db.start()
+
+    def tearDown(self):
+        self.db.stop()
+        self.tmp.cleanup()
+
+    def test_quarantine(self):
+        '''test_quarantine'''
+        tracker = syphon.Tracker(self.db, 3)
+        error = OSError("busy")
+        self.assertEqual(tracker.failed("a", "sig", error), "failed")
+        self.assertEqual(tracker.failed("a", "sig", error), "failed")
+        self.assertFalse(tracker.quarantined("a", "sig"))
+        self.assertEqual(tracker.failed("a", "sig", error), "quarantined")
+        self.assertTrue(tracker.quarantined("a", "sig"))
+        self.assertFalse(tracker.quarantined("a", "changed"))
+        self.assertFalse(tracker.quarantined("b", "sig"))
+
+    def test_changed(self):
+        '''test_changed'''
+        tracker = syphon.Tracker(self.db, 2)
+        tracker.failed("a", "sig", OSError("busy"))
+        # A changed source starts counting again
+        self.assertEqual(tracker.failed("a", "changed", OSError("busy")),
+                         "failed")
+        self.assertEqual(tracker.failed("a", "changed", OSError("busy")),
+                         "quarantined")
+
+    def test_permanent(self):
+        '''test_permanent'''
+        tracker = syphon.Tracker(self.db, 3)
+        self.assertTrue(syphon.Tracker.permanent(
+            syphon.StageError("bad", True)))
+        self.assertFalse(syphon.Tracker.permanent(syphon.StageError("bad")))
+        self.assertEqual(tracker.failed("a", "sig",
+                                        syphon.StageError("bad", True)),
+                         "quarantined")
+        self.assertEqual(tracker.failed("b", "sig",
+                                        syphon.StageError("bad")), "failed")
+
+    def test_succeeded(self):
+        '''test_succeeded'''
+        tracker = syphon.Tracker(self.db, 2)
+        tracker.failed("a", "sig", OSError("busy"))
+        tracker.succeeded("a", "sig")
+        self.assertEqual(tracker.failed("a", "sig", OSError("busy")),
+                         "failed")
+
+    def test_persisted(self):
+        '''test_persisted'''
+        tracker = syphon.Tracker(self.db, 3)
+        tracker.failed("a", "sig", syphon.StageError("bad", True))
+        tracker.failed("b", "sig", OSError("busy"))
+        self.db.flush()
+        self.assertEqual(self.db.query('SELECT Artifact, Status, Attempts, ' +
+                                       'Error FROM Tracks ORDER BY Artifact'),
+                         [("a", "quarantined", 1, "StageError: bad"),
+                          ("b", "failed", 1, "OSError: busy")])
+        reloaded = syphon.Tracker(self.db, 3)
+        self.assertTrue(reloaded.quarantined("a", "sig"))
+        reloaded.failed("b", "sig", OSError("busy"))
+        self.assertEqual(reloaded.failed("b", "sig", OSError("busy")),
+                         "quarantined")
+
+
+class AttemptTrackTest(unittest.TestCase):
+    '''AttemptTrackTest'''
+    def attempttrack(self, errors, attempts=3):
+        '''attempttrack'''
+        calls = []
+
+        def processtrack(job, src):
+            calls.append(src)
+            if errors:
+                raise errors.pop(0)
+        instance = object.__new__(syphon.Syphon)
+        instance._Syphon__config = types.SimpleNamespace(
+            retry={"attempts": attempts, "backoff": 0.0})
+        instance._Syphon__processtrack = processtrack
+        job = types.SimpleNamespace(metrics=syphon.Metrics())
+        error = instance._Syphon__attempttrack(job, "/music/a.ogg")
+        retries = job.metrics.report()["stages"].get("retry", {})
+        return error, len(calls), retries.get("count", 0)
+
+    def test_recovers(self):
+        '''test_recovers'''
+        self.assertEqual(self.attempttrack([OSError("busy")]),
+                         (None, 2, 1))
+
+    def test_exhausted(self):
+        '''test_exhausted'''
+        error, calls, retries = self.attempttrack(
+            [OSError(str(i)) for i in range(3)])
+        self.assertEqual(str(error), "2")
+        self.assertEqual((calls, retries), (3, 2))
+
+    def test_permanent(self):
+        '''test_permanent'''
+        error, calls, retries = self.attempttrack(
+            [syphon.StageError("bad", True), OSError("busy")])
+        self.assertTrue(error.permanent)
+        self.assertEqual((calls, retries), (1, 0))
+
+
+if __name__ == "__main__":
+    unittest.main()